@@ -1,13 +1,18 @@
+import multiprocessing
 import time
+from array import array
 from collections import deque
 from io import BytesIO
 from typing import Tuple, Set
 
 import networkx as nx
+import z3
 from matplotlib import pyplot as plt
 from networkx import DiGraph
 
-from parser.smt_utils import check_cycle_sat
+from domain.graphUtils import UndirectedGraph, FrozenGraph
+from parser.smt_utils import check_cycle_sat, add_cycle_assertions, get_cycle_unsat_core, get_solver, \
+    get_free_constants
 from parser.system_parser import *
 from resources.system_examples import *
 
@@ -17,6 +22,14 @@ SHOW_INVALID_DAG_IMAGE = False
 ENABLE_PRINT = False
 ADD_REDUNDANT_SEQ_OP = False
 VISIT_FUTURE_ONLY = True
+INCREMENTAL_CYCLE_SAT = False
+UNSAT_CORE_PRUNING = True
+CYCLE_COMPONENTS = True
+CYCLE_SEARCH_WORKERS = 1
+CANONICAL_CLONE_CYCLES = True
+MAX_CYCLE_LENGTH = None
+ITERATIVE_DEEPENING = False
+ANALYSIS_TIME_BUDGET_S = None
 
 
 def set_self_loop_budget(budget):
@@ -24,6 +37,63 @@ def set_self_loop_budget(budget):
     SELF_LOOP_BUDGET = budget
 
 
+def set_incremental_cycle_sat(incremental):
+    global INCREMENTAL_CYCLE_SAT
+    INCREMENTAL_CYCLE_SAT = incremental
+
+
+def set_unsat_core_pruning(pruning):
+    global UNSAT_CORE_PRUNING
+    UNSAT_CORE_PRUNING = pruning
+
+
+def set_cycle_components(enabled):
+    global CYCLE_COMPONENTS
+    CYCLE_COMPONENTS = enabled
+
+
+def set_cycle_search_workers(workers):
+    global CYCLE_SEARCH_WORKERS
+    CYCLE_SEARCH_WORKERS = workers
+
+
+def set_canonical_clone_cycles(enabled):
+    global CANONICAL_CLONE_CYCLES
+    CANONICAL_CLONE_CYCLES = enabled
+
+
+def set_max_cycle_length(length):
+    global MAX_CYCLE_LENGTH
+    MAX_CYCLE_LENGTH = length
+
+
+def set_iterative_deepening(enabled):
+    global ITERATIVE_DEEPENING
+    ITERATIVE_DEEPENING = enabled
+
+
+def set_analysis_time_budget(seconds):
+    global ANALYSIS_TIME_BUDGET_S
+    ANALYSIS_TIME_BUDGET_S = seconds
+
+
+class AnalysisStatus:
+    # how complete the results of an analysis are: cut short by the time budget, or holding cycles
+    # whose satisfiability z3 could not decide. with a cycle length bound, whether a path was cut by it,
+    # and with iterative deepening, the length up to which all cycles have been found
+    def __init__(self, time_budget=None):
+        self.deadline = time.monotonic() + time_budget if time_budget is not None else None
+        self.complete = True
+        self.unknown_cycles = set()
+        self.length_bound_reached = False
+        self.complete_length = 0
+
+    def out_of_time(self):
+        if self.complete and self.deadline is not None and time.monotonic() > self.deadline:
+            self.complete = False
+        return not self.complete
+
+
 def set_show_dag(show):
     global SHOW_DAG_IMAGE
     SHOW_DAG_IMAGE = show
@@ -31,6 +101,9 @@ def set_show_dag(show):
 
 def is_valid_cycle(path, graph: UndirectedGraph):
 
+    if isinstance(graph, FrozenGraph):
+        return is_valid_frozen_cycle(path, graph)
+
     external_from_initial_bt = [i for i in path if i not in graph.get_business_sequence_of(path[0])]
     if not len(external_from_initial_bt) > 0:
         #print("removing due to not visiting external", path)
@@ -45,32 +118,70 @@ def is_valid_cycle(path, graph: UndirectedGraph):
         raise ValueError("this should not happen")
 
     if VISIT_FUTURE_ONLY:
-        sorted_lt_by_owner = sorted(list(map(lambda lt: (lt.bt_owner.name, lt.label), path)), key=lambda x: x[0])
-        separated_by_owners = {}
-        for tuple in sorted_lt_by_owner:
-            key = tuple[0]
-            if key in separated_by_owners:
-                separated_by_owners[key].append(tuple)
-            else:
-                separated_by_owners[key] = [tuple]
-
-        cycle_is_in_future_order = True
-        for lts_with_same_bt in separated_by_owners.values():
-            for i in range(len(lts_with_same_bt) - 1):
-                current = lts_with_same_bt[i]
-                next = lts_with_same_bt[i + 1]
-                if int(current[1]) > int(next[1]):
-                    cycle_is_in_future_order = False
-
-        if not cycle_is_in_future_order:
-            #print("will delete due to not future order", path)
-            return False, []
+        orders = {}
+        for lt in path:
+            orders = extend_future_order(orders, lt.bt_owner.name, int(lt.label))
+            if orders is None:
+                #print("will delete due to not future order", path)
+                return False, []
 
     result, assertions = check_cycle_sat(path, graph)
     return result, assertions
 
 
+def is_valid_frozen_cycle(path, graph: FrozenGraph):
+    # same checks as is_valid_cycle, on a path of node ids
+
+    if not is_frozen_cycle_candidate(path, graph):
+        return False, []
+
+    return check_cycle_sat([graph.nodes[i] for i in path], graph)
+
+
+def is_frozen_cycle_candidate(path, graph: FrozenGraph):
+    # the checks of is_valid_cycle that come before the satisfiability check
+
+    if all(graph.in_business_sequence_of(i, path[0]) for i in path):
+        return False
+
+    if starts_in_future(path[0], path[-1], graph):
+        return False
+
+    if graph.owner[path[0]] != graph.owner[path[-1]]:
+        raise ValueError("this should not happen")
+
+    if VISIT_FUTURE_ONLY:
+        orders = {}
+        for i in path:
+            orders = extend_future_order(orders, graph.owner_name[i], graph.order[i])
+            if orders is None:
+                return False
+
+    return True
+
+
+def starts_in_future(start, end, graph: FrozenGraph):
+    # a cycle closing on a node of its own sequence that comes before its start
+    return graph.sequence_of[start] == graph.sequence_of[end] and graph.order[start] > graph.order[end]
+
+
+def extend_future_order(orders, owner, order):
+    # orders of the last node of each bt owner on a path, after visiting a node of owner with order.
+    # None when the node goes back in the order of its owner, no path extending it visits the future only
+    if owner in orders:
+        if orders[owner] > order:
+            return None
+        if orders[owner] == order:
+            return orders
+    extended = dict(orders)
+    extended[owner] = order
+    return extended
+
+
 def number_of_cloned_bt_in_path(path, graph):
+    if isinstance(graph, FrozenGraph):
+        return len({graph.sequence_of[i] for i in path if graph.cloned[i]})
+
     seen = set()
     for node in path:
         if node.cloned and node not in seen:
@@ -79,49 +190,478 @@ def number_of_cloned_bt_in_path(path, graph):
     return len(seen)
 
 
-def dfs_cycles(graph: UndirectedGraph, valid_starting_points: Set[BusinessTransactionUnit]):
+def dfs_cycles(graph: UndirectedGraph, valid_starting_points: Set[BusinessTransactionUnit], status=None):
     cycles = set()
     used_edges = dict()
     cycle_assertions = dict()
+    for cycle, edges, assertions in iter_cycles(graph, valid_starting_points, status):
+        cycles.add(cycle)
+        used_edges[cycle] = edges
+        cycle_assertions[cycle] = assertions
+    return cycles, used_edges, cycle_assertions
 
-    for node in valid_starting_points:
 
+def iter_cycles(graph: UndirectedGraph, valid_starting_points: Set[BusinessTransactionUnit], status=None,
+                checkpoint=None):
+    # yields (cycle, used edges, assertions) for each valid cycle as soon as it is found. with iterative
+    # deepening the cycles come by length, checkpoint(length) is called once all cycles of a length are out
+    status = status or AnalysisStatus()
+
+    # the search runs on node and label ids of the frozen graph, results are mapped back to nodes
+    frozen = graph if isinstance(graph, FrozenGraph) else graph.freeze()
+
+    starts_by_component, on_cycle = get_starts_by_component(frozen, valid_starting_points)
+    starts = [start for component_starts in starts_by_component for start in component_starts]
+
+    if ITERATIVE_DEEPENING:
+        return iter_cycles_by_length(frozen, starts, on_cycle, status, checkpoint)
+
+    return iter_cycles_of_length(frozen, starts, on_cycle, status, 0, MAX_CYCLE_LENGTH)
+
+
+def iter_cycles_by_length(frozen: FrozenGraph, starts, on_cycle, status, checkpoint):
+    # one search per cycle length, each bounded by it, until no path is cut by the bound. a path that is a
+    # valid shorter cycle is not extended, the cycles of all levels are those of a single search
+    length = 2
+    while MAX_CYCLE_LENGTH is None or length <= MAX_CYCLE_LENGTH:
+        status.length_bound_reached = False
+        yield from iter_cycles_of_length(frozen, starts, on_cycle, status, length, length)
+        if status.out_of_time():
+            return
+
+        status.complete_length = length
+        if checkpoint is not None:
+            checkpoint(length)
+        if not status.length_bound_reached:
+            return
+        length += 1
+
+
+def iter_cycles_of_length(frozen: FrozenGraph, starts, on_cycle, status, min_length, max_length):
+    # cycles of min_length to max_length nodes, paths are not extended past max_length when it is set
+    if CYCLE_SEARCH_WORKERS > 1 and len(starts) > 1 and "fork" in multiprocessing.get_all_start_methods():
+        return iter_cycles_in_workers(frozen, starts, on_cycle, status, min_length, max_length)
+
+    return iter_cycles_from(frozen, starts, on_cycle, get_symmetric_clones(frozen), status, min_length, max_length)
+
+
+def iter_cycles_from(frozen: FrozenGraph, starts, on_cycle, mirrors, status, min_length=0, max_length=None):
+    if INCREMENTAL_CYCLE_SAT:
+        for start in starts:
+            yield from iter_cycles_incremental(frozen, start, on_cycle, mirrors, status, min_length, max_length)
+        return
+
+    offsets, neighbours, edge_labels = frozen.offsets, frozen.neighbours, frozen.edge_labels
+    pair_of, mirrored = mirrors
+
+    # unsat cores of failed cycles, as sets of assertion ids. a path holding all the assertions of one
+    # of them can not become a valid cycle
+    nogoods = []
+    nogoods_by_assertion = dict()
+    edge_assertion_ids = None
+    if UNSAT_CORE_PRUNING:
+        edge_assertion_ids = [frozenset(a.get_id() for a in assertions if z3.is_expr(a))
+                              for assertions in frozen.edge_assertions]
+
+    for start in starts:
+
+        # a path is a chain of (node, label, previous step) steps shared with the paths extending it, with
+        # its nodes as a bitset and the business sequences of its cloned nodes as a bitset and a count.
+        # the checks of is_frozen_cycle_candidate are kept up to date as the path grows, only paths
+        # that are checked as cycles are turned into lists
         q = deque()
-        q.append((node, [node], [(node, "start")], 0))
+        start_sequence_bit = get_cloned_sequence_bit(start, frozen)
+        start_orders = extend_future_order({}, frozen.owner_name[start], frozen.order[start])
+        q.append(((start, -1, None), 1 << start, start_sequence_bit, int(start_sequence_bit > 0), start_orders, False,
+                  0, frozenset(), 0, 1))
 
         while q:
 
-            curr_node, path, edges, self_loop_counter = q.pop()
+            if status.out_of_time():
+                return
+
+            step, members, cloned_sequences, cloned_count, orders, left_start_sequence, entered_pairs, \
+                assertion_ids, known_nogoods, length = q.pop()
+            curr_node, curr_label = step[0], step[1]
+
+            if any(nogood <= assertion_ids for nogood in nogoods[known_nogoods:]):
+                continue
+
+            if frozen.in_business_sequence_of(curr_node, start) and curr_node != start and left_start_sequence and \
+                    not starts_in_future(start, curr_node, frozen):
+                if frozen.owner[start] != frozen.owner[curr_node]:
+                    raise ValueError("this should not happen")
+
+                path, labels = get_step_path(step)
 
-            if curr_node in graph.get_business_sequence_of(node) and curr_node != node:
+                cycle = tuple(frozen.nodes[i] for i in path)
+                is_valid, assertions = check_cycle_sat(cycle, frozen)
+                if is_valid is not False:
+                    if length >= min_length:
+                        if is_valid is None:
+                            status.unknown_cycles.add(cycle)
+                        yield cycle, get_used_edges(path, labels, frozen), assertions
+                    continue
+
+                if UNSAT_CORE_PRUNING:
+                    nogood = get_cycle_unsat_core(cycle, frozen)
+                    if nogood:
+                        for a in nogood:
+                            nogoods_by_assertion.setdefault(a, []).append(nogood)
+                        nogoods.append(nogood)
+                        continue
+
+            for k in range(offsets[curr_node], offsets[curr_node + 1]):
+                neighbour, label = neighbours[k], edge_labels[k]
 
-                is_valid, assertions = is_valid_cycle(path, graph)
-                if is_valid:
-                    cycles.add(tuple(path))
-                    used_edges[tuple(path)] = (tuple(edges))
-                    cycle_assertions[tuple(path)] = assertions
+                if not on_cycle[k]:
                     continue
 
-            for (neighbour, label) in graph.get_neighbours(curr_node):
+                # a node is only visited again through its self loop, taken once
+                if (neighbour == curr_node and label != curr_label) or not (members >> neighbour) & 1:
 
-                if (neighbour not in path or neighbour == curr_node) and (neighbour, label) not in edges:
+                    next_cloned_sequences, next_cloned_count = cloned_sequences, cloned_count
+                    sequence_bit = get_cloned_sequence_bit(neighbour, frozen)
+                    if sequence_bit and not cloned_sequences & sequence_bit:
+                        next_cloned_sequences |= sequence_bit
+                        next_cloned_count += 1
 
-                    next_self_loop_counter = self_loop_counter
+                    if next_cloned_count > SELF_LOOP_BUDGET:
+                        continue
 
-                    if neighbour.cloned:
-                        next_self_loop_counter += 1
+                    next_orders = orders
+                    if VISIT_FUTURE_ONLY:
+                        next_orders = extend_future_order(orders, frozen.owner_name[neighbour], frozen.order[neighbour])
+                        if next_orders is None:
+                            continue
 
-                    if number_of_cloned_bt_in_path(path + [neighbour], graph) > SELF_LOOP_BUDGET:
+                    next_entered_pairs = enter_mirror_pair(entered_pairs, neighbour, start, pair_of, mirrored)
+                    if next_entered_pairs is None:
                         continue
 
-                    q.append((neighbour, path + [neighbour], edges + [(neighbour, label)], next_self_loop_counter))
+                    next_assertion_ids = assertion_ids
+                    if UNSAT_CORE_PRUNING and not edge_assertion_ids[k] <= assertion_ids:
+                        new_ids = edge_assertion_ids[k] - assertion_ids
+                        next_assertion_ids = assertion_ids | new_ids
+                        if any(nogood <= next_assertion_ids
+                               for a in new_ids for nogood in nogoods_by_assertion.get(a, ())):
+                            continue
 
-    return cycles, used_edges, cycle_assertions
+                    if max_length is not None and length >= max_length:
+                        status.length_bound_reached = True
+                        continue
+
+                    q.append(((neighbour, label, step), members | (1 << neighbour), next_cloned_sequences,
+                              next_cloned_count, next_orders,
+                              left_start_sequence or not frozen.in_business_sequence_of(neighbour, start),
+                              next_entered_pairs, next_assertion_ids, len(nogoods), length + 1))
+
+
+def get_symmetric_clones(frozen: FrozenGraph):
+    # (pair_of, mirrored), for business transactions whose Parallel clone mirrors them exactly, the sequence
+    # id of the original (-1 for the others), and whether a node is on the clone side. a cycle through
+    # such a clone and its mirror image through the original are the same conflict
+    pair_of = array("i", [-1] * len(frozen))
+    mirrored = bytearray(len(frozen))
+    if not CANONICAL_CLONE_CYCLES:
+        return pair_of, mirrored
+
+    sequences_by_owner = {}
+    for sequence in frozen.sequences:
+        owner = getattr(frozen.nodes[sequence[0]].bt_owner, "name", None)
+        sequences_by_owner.setdefault(owner, []).append(sequence)
+
+    for owner, sequences in sequences_by_owner.items():
+        clones = sequences_by_owner.get(f"{owner}Parallel", [])
+        if owner is None or len(sequences) != 1 or len(clones) != 1:
+            continue
+        original, clone = sequences[0], clones[0]
+        if is_mirror(original, clone, owner, frozen):
+            for i, j in zip(original, clone):
+                pair_of[i] = pair_of[j] = frozen.sequence_of[original[0]]
+                mirrored[j] = 1
+
+    return pair_of, mirrored
+
+
+def enter_mirror_pair(entered, i, start, pair_of, mirrored):
+    # the mirror pairs a path has entered after visiting node i, None when i is on the clone side of a pair
+    # the path had not entered, as the mirror image through the original is searched instead. the pair of
+    # the starting node is not symmetric, the start is always on the original side
+    p = pair_of[i]
+    if p == -1 or p == pair_of[start] or (entered >> p) & 1:
+        return entered
+    if mirrored[i]:
+        return None
+    return entered | (1 << p)
+
+
+def is_mirror(original, clone, owner, frozen: FrozenGraph):
+    # swapping the two sequences, and the variables named after their units and owners, maps every edge
+    # to an edge with the same assertions, and keeps the order of the nodes in each sequence
+    if len(original) != len(clone) or any(frozen.cloned[i] or not frozen.cloned[j] for i, j in zip(original, clone)):
+        return False
+    if sorted(range(len(original)), key=lambda k: frozen.order[original[k]]) != \
+            sorted(range(len(clone)), key=lambda k: frozen.order[clone[k]]):
+        return False
+
+    swap = dict(zip(original, clone))
+    swap.update(zip(clone, original))
+    suffixes = {f"_{owner}": f"_{owner}Parallel", f"_{owner}Parallel": f"_{owner}"}
+    for i, j in zip(original, clone):
+        suffixes[f"_{frozen.labels[i]}"] = f"_{frozen.labels[j]}"
+        suffixes[f"_{frozen.labels[j]}"] = f"_{frozen.labels[i]}"
+
+    edges = {}
+    for i in swap:
+        for k in range(frozen.offsets[i], frozen.offsets[i + 1]):
+            edges[(i, frozen.neighbours[k])] = k
+
+    renaming = {}
+    for (i, j), k in edges.items():
+        for a in frozen.edge_assertions[k]:
+            for c in get_free_constants([a]):
+                name = str(c)
+                for suffix, other in suffixes.items():
+                    if name.endswith(suffix):
+                        renaming[c.get_id()] = (c, z3.Const(name[:-len(suffix)] + other, c.sort()))
+                        break
+
+    for (i, j), k in edges.items():
+        mirror_k = get_edge_index(frozen, swap.get(i, i), swap.get(j, j))
+        if mirror_k is None:
+            return False
+        if is_unknown_edge_label(frozen.edge_label_names[frozen.edge_labels[k]]) != \
+                is_unknown_edge_label(frozen.edge_label_names[frozen.edge_labels[mirror_k]]):
+            return False
+        assertions, mirror_assertions = frozen.edge_assertions[k], frozen.edge_assertions[mirror_k]
+        if len(assertions) != len(mirror_assertions):
+            return False
+        for a, b in zip(assertions, mirror_assertions):
+            if z3.is_expr(a) != z3.is_expr(b):
+                return False
+            if not z3.is_expr(a):
+                if a != b:
+                    return False
+            elif not (z3.substitute(a, *renaming.values()) if renaming else a).eq(b):
+                return False
+
+    return True
+
+
+def get_edge_index(frozen: FrozenGraph, i, j):
+    for k in range(frozen.offsets[i], frozen.offsets[i + 1]):
+        if frozen.neighbours[k] == j:
+            return k
+    return None
+
+
+def get_step_path(step):
+    # the nodes of a path from its start, with the labels of the edges reaching them
+    path, labels = [], []
+    while step is not None:
+        path.append(step[0])
+        labels.append(step[1])
+        step = step[2]
+    path.reverse()
+    labels.reverse()
+    return path, labels
+
+
+def get_used_edges(path, labels, graph: FrozenGraph):
+    # (node, label) pairs of a cycle with the labels as shown to users, the start is reached by no edge
+    used_edges = [(graph.nodes[path[0]], "start")]
+    for previous, i, label in zip(path, path[1:], labels[1:]):
+        assertions = graph.edge_assertions[get_edge_index(graph, previous, i)]
+        used_edges.append((graph.nodes[i], get_edge_label_text(graph.edge_label_names[label], assertions)))
+    return tuple(used_edges)
+
+
+def get_cloned_sequence_bit(i, graph: FrozenGraph):
+    # bit of the business sequence of a cloned node, 0 for nodes that are not cloned
+    return 1 << (graph.sequence_of[i] + 1) if graph.cloned[i] else 0
+
+
+# frozen graph, adjacency filter, clone mirrors, status and length bounds of the cycle search, inherited by the
+# forked workers
+_search_to_run = None
+
+
+def iter_cycles_in_workers(frozen: FrozenGraph, starts, on_cycle, status, min_length=0, max_length=None):
+    # each starting node is searched by a forked worker, nodes hold predicates that can not be pickled
+    global _search_to_run
+    _search_to_run = (frozen, on_cycle, get_symmetric_clones(frozen), status, min_length, max_length)
+    try:
+        with multiprocessing.get_context("fork").Pool(CYCLE_SEARCH_WORKERS) as pool:
+            # in the order of the starts, the cycles found from a start all begin with it
+            for found, complete, length_bound_reached in pool.imap(_iter_cycles_in_worker, starts, 1):
+                if not complete:
+                    status.complete = False
+                if length_bound_reached:
+                    status.length_bound_reached = True
+                for path, edges, unknown in found:
+                    cycle = tuple(frozen.nodes[i] for i in path)
+                    if unknown:
+                        status.unknown_cycles.add(cycle)
+                    # z3 terms of the workers stay in their processes, the condition is built again from the edges
+                    yield cycle, tuple((frozen.nodes[i], label) for i, label in edges), \
+                        add_cycle_assertions(z3.Solver(), cycle, frozen)
+    finally:
+        _search_to_run = None
+
+
+def _iter_cycles_in_worker(start):
+    frozen, on_cycle, mirrors, status, min_length, max_length = _search_to_run
+    found = [(tuple(frozen.index[n] for n in cycle), tuple((frozen.index[n], label) for n, label in edges),
+              cycle in status.unknown_cycles)
+             for cycle, edges, _ in iter_cycles_from(frozen, [start], on_cycle, mirrors, status,
+                                                     min_length, max_length)]
+    return found, status.complete, status.length_bound_reached
+
+
+def get_starts_by_component(frozen: FrozenGraph, valid_starting_points):
+    # the starting node ids grouped by cycle component, with the adjacency entries cycles can use.
+    # cycles never leave the component of their start, starts outside any component have none
+    if not CYCLE_COMPONENTS:
+        return [[frozen.index[node] for node in valid_starting_points]], bytearray(b"\x01") * len(frozen.neighbours)
+
+    component, on_cycle = frozen.get_cycle_components()
+    starts_by_component = dict()
+    for node in valid_starting_points:
+        start = frozen.index[node]
+        if component[start] != -1:
+            starts_by_component.setdefault(component[start], []).append(start)
+    return list(starts_by_component.values()), on_cycle
+
+
+def iter_cycles_incremental(frozen: FrozenGraph, start, on_cycle, mirrors, status, min_length=0, max_length=None):
+    # same search as dfs_cycles from one starting node, depth first with one solver whose scopes follow
+    # the path, a path prefix that goes unsat is not extended
+    solver = get_solver()
+    path, edges = [start], [(start, -1)]
+    sat_statuses = [z3.sat]
+    pushed = [False]
+    future_orders = [extend_future_order({}, frozen.owner_name[start], frozen.order[start])]
+    pair_of, mirrored = mirrors
+    entered_pairs = [0]
+    # as in iter_cycles_from, the nodes of the path and the self loops it took as bitsets, and the business
+    # sequences of its cloned nodes as a bitset and a count
+    start_sequence_bit = get_cloned_sequence_bit(start, frozen)
+    visits = [(1 << start, 0, start_sequence_bit, int(start_sequence_bit > 0))]
+    # ids of the assertions in the solver, with the number of scopes that added them
+    asserted = dict()
+    asserted_by_scope = []
+    frames = [iter(range(frozen.offsets[start], frozen.offsets[start + 1]))]
+
+    def retract():
+        path.pop()
+        edges.pop()
+        future_orders.pop()
+        entered_pairs.pop()
+        visits.pop()
+        sat_statuses.pop()
+        if pushed.pop():
+            solver.pop()
+            for a in asserted_by_scope.pop():
+                asserted[a] -= 1
+                if not asserted[a]:
+                    del asserted[a]
+
+    while frames:
+        if status.out_of_time():
+            return
+
+        k = next(frames[-1], None)
+        if k is None:
+            frames.pop()
+            if frames:
+                retract()
+            continue
+
+        curr_node, curr_label = edges[-1]
+        neighbour, label = frozen.neighbours[k], frozen.edge_labels[k]
+
+        if not on_cycle[k]:
+            continue
+
+        members, self_loops, cloned_sequences, cloned_count = visits[-1]
+        if (members >> neighbour) & 1 and \
+                not (neighbour == curr_node and label != curr_label and not (self_loops >> k) & 1):
+            continue
+
+        sequence_bit = get_cloned_sequence_bit(neighbour, frozen)
+        if sequence_bit and not cloned_sequences & sequence_bit:
+            cloned_sequences |= sequence_bit
+            cloned_count += 1
+
+        if cloned_count > SELF_LOOP_BUDGET:
+            continue
+
+        orders = future_orders[-1]
+        if VISIT_FUTURE_ONLY:
+            orders = extend_future_order(orders, frozen.owner_name[neighbour], frozen.order[neighbour])
+            if orders is None:
+                continue
+
+        entered = enter_mirror_pair(entered_pairs[-1], neighbour, start, pair_of, mirrored)
+        if entered is None:
+            continue
+
+        if max_length is not None and len(path) >= max_length:
+            status.length_bound_reached = True
+            continue
+
+        path.append(neighbour)
+        edges.append((neighbour, label))
+        future_orders.append(orders)
+        entered_pairs.append(entered)
+        visits.append((members | (1 << neighbour), self_loops | ((neighbour == curr_node) << k), cloned_sequences,
+                       cloned_count))
+
+        new_assertions = [a for a in frozen.edge_assertions[k] if not z3.is_expr(a) or a.get_id() not in asserted]
+        sat_status = sat_statuses[-1]
+        if new_assertions:
+            solver.push()
+            ids = [a.get_id() for a in new_assertions if z3.is_expr(a)]
+            for a in new_assertions:
+                solver.add(a)
+            for a in ids:
+                asserted[a] = asserted.get(a, 0) + 1
+            asserted_by_scope.append(ids)
+            sat_status = solver.check()
+        sat_statuses.append(sat_status)
+        pushed.append(bool(new_assertions))
+
+        if sat_status == z3.unsat:
+            retract()
+            continue
+
+        if frozen.in_business_sequence_of(neighbour, start) and neighbour != start and \
+                is_frozen_cycle_candidate(path, frozen):
+            if sat_status != z3.sat:
+                sat_status = solver.check()
+            if sat_status != z3.unsat:
+                if len(path) >= min_length:
+                    cycle = tuple(frozen.nodes[i] for i in path)
+                    if sat_status == z3.unknown:
+                        status.unknown_cycles.add(cycle)
+                    yield cycle, get_used_edges(path, [label for _, label in edges], frozen), \
+                        add_cycle_assertions(z3.Solver(), cycle, frozen)
+                retract()
+                continue
+
+        frames.append(iter(range(frozen.offsets[neighbour], frozen.offsets[neighbour + 1])))
 
 
 def generate_dependency_dag(graph: UndirectedGraph, cycle: Tuple[BusinessTransactionUnit]):
     dag = nx.DiGraph()
 
+    # on a frozen graph the cycle holds node ids, the dag is labelled the same way
+    if isinstance(graph, FrozenGraph):
+        label_of, order_of = graph.labels.__getitem__, graph.order.__getitem__
+    else:
+        label_of, order_of = lambda n: n.label, lambda n: int(n.label)
+
     skip_counter = 0
     for index, node in enumerate(cycle):
         if skip_counter > 0:
@@ -130,14 +670,14 @@ def generate_dependency_dag(graph: UndirectedGraph, cycle: Tuple[BusinessTransac
 
         business_sequence = graph.get_business_sequence_of(node)
         for previous_in_sequence, current_in_sequence in zip(business_sequence, business_sequence[1:]):
-            if int(current_in_sequence.label) > int(node.label):
+            if order_of(current_in_sequence) > order_of(node):
                 break
-            dag.add_edge(previous_in_sequence.label, current_in_sequence.label)
+            dag.add_edge(label_of(previous_in_sequence), label_of(current_in_sequence))
 
         # connect to next node in cycle
         for next_node in cycle[index + 1:]:
-           if not dag.has_node(next_node.label):
-               dag.add_edge(node.label, next_node.label)
+           if not dag.has_node(label_of(next_node)):
+               dag.add_edge(label_of(node), label_of(next_node))
                break
            else:
                print("DIDNT ADD EDGE")
@@ -145,7 +685,7 @@ def generate_dependency_dag(graph: UndirectedGraph, cycle: Tuple[BusinessTransac
             # using reverse to check if the current node is going to connect to something in the past
            reversed = dag.reverse(copy=True)
            print("HELLO REVERSE CHECK")
-           if nx.has_path(reversed, node.label, next_node.label):
+           if nx.has_path(reversed, label_of(node), label_of(next_node)):
                print("SKIPPING DUE TO REVERSE PATH FOUND")
                skip_counter += 1
                continue
@@ -154,8 +694,8 @@ def generate_dependency_dag(graph: UndirectedGraph, cycle: Tuple[BusinessTransac
         for index, node in enumerate(cycle):
            business_sequence = graph.get_business_sequence_of(node)
            for previous_in_sequence, current_in_sequence in zip(business_sequence, business_sequence[1:]):
-               if not dag.has_edge(previous_in_sequence.label, current_in_sequence.label):
-                   dag.add_edge(previous_in_sequence.label, current_in_sequence.label)
+               if not dag.has_edge(label_of(previous_in_sequence), label_of(current_in_sequence)):
+                   dag.add_edge(label_of(previous_in_sequence), label_of(current_in_sequence))
 
     return dag
 
@@ -192,42 +732,68 @@ def get_valid_starting_nodes(graph: UndirectedGraph):
 
 def generate_dags(cycles: Set[Tuple[BusinessTransactionUnit]], graph: UndirectedGraph):
     dags = set()
+    seen_dags = set()
     for cycle in cycles:
 
         dag_result = generate_dependency_dag(graph, cycle)
 
-        if not any(d.edges == dag_result.edges and d.nodes == dag_result.nodes for _, d in dags):
+        if add_new_dag(dag_result, seen_dags):
             dags.add((cycle, dag_result))
     return dags
 
 
-def generate_topological_paths(dags: Set[Tuple[Tuple[BusinessTransactionUnit], DiGraph]]):
+def add_new_dag(dag: DiGraph, seen_dags):
+    # False when a dag with the same nodes and edges was seen before
+    key = (frozenset(dag.nodes), frozenset(dag.edges))
+    if key in seen_dags:
+        return False
+    seen_dags.add(key)
+    return True
+
+
+def generate_topological_paths(dags: Set[Tuple[Tuple[BusinessTransactionUnit], DiGraph]], status=None):
     topological_paths_all = set()
     topological_paths_for_cycle = []
 
     for c, d in dags:
-        try:
-            topological_paths = [tuple(topological_path) for topological_path in nx.all_topological_sorts(d)]
-            topological_paths_all.update(topological_paths)
-            topological_paths_for_cycle.append((c, topological_paths))
-
-            if SHOW_DAG_IMAGE:
-                print(c)
-                pos = nx.spring_layout(d)
-                nx.draw(d, pos, with_labels=True)
-                plt.show()
-                plt.close()
-        except Exception as err:
-            print("error", c, err)
-            if SHOW_INVALID_DAG_IMAGE:
-                pos = nx.spring_layout(d)
-                nx.draw(d, pos, with_labels=True)
-                plt.show()
-                plt.close()
+        if status and status.out_of_time():
+            break
+        add_topological_paths(c, d, iter_topological_paths(d, status), topological_paths_for_cycle,
+                              topological_paths_all)
 
     return topological_paths_for_cycle, topological_paths_all
 
 
+def iter_topological_paths(dag: DiGraph, status=None):
+    # topological sorts of a dependency dag, one at a time
+    for topological_path in nx.all_topological_sorts(dag):
+        # out of time, the paths found so far are kept
+        if status and status.out_of_time():
+            return
+        yield tuple(topological_path)
+
+
+def add_topological_paths(c, d, paths, topological_paths_for_cycle, topological_paths_all):
+    try:
+        topological_paths = list(paths)
+        topological_paths_all.update(topological_paths)
+        topological_paths_for_cycle.append((c, topological_paths))
+
+        if SHOW_DAG_IMAGE:
+            print(c)
+            pos = nx.spring_layout(d)
+            nx.draw(d, pos, with_labels=True)
+            plt.show()
+            plt.close()
+    except Exception as err:
+        print("error", c, err)
+        if SHOW_INVALID_DAG_IMAGE:
+            pos = nx.spring_layout(d)
+            nx.draw(d, pos, with_labels=True)
+            plt.show()
+            plt.close()
+
+
 def generate_system_graph_image(graph):
     nx_graph = nx.DiGraph()
 
@@ -236,11 +802,12 @@ def generate_system_graph_image(graph):
             continue
         nx_graph.add_node(node)
 
-    for node, neighbors in graph.nodes().items():
-        for neighbor in neighbors:
-            if "Parallel" in str(neighbor[0]) or "Parallel" in str(node):
+    for node in graph.nodes():
+        for neighbor, label in graph.iter_neighbours(node):
+            if "Parallel" in str(neighbor) or "Parallel" in str(node):
                 continue
-            nx_graph.add_edge(node, neighbor[0], label=neighbor[1])
+            label = get_edge_label_text(label, graph.get_assertions_of_nodes(node, neighbor))
+            nx_graph.add_edge(node, neighbor, label=label)
 
     for business_sequence in graph.business_sequences():
         for previous_in_sequence, current_in_sequence in zip(business_sequence, business_sequence[1:]):
@@ -268,14 +835,15 @@ def generate_system_graph_image(graph):
 
 def generate_system_graph_image_2(graph):
     nx_graph = nx.Graph()
-    for node, neighbors in graph.nodes().items():
+    for node in graph.nodes():
         if "Parallel" in str(node):
             continue
         nx_graph.add_node(node)
-        for neighbor in neighbors:
-            if "Parallel" in str(neighbor[0]):
+        for neighbor, label in graph.iter_neighbours(node):
+            if "Parallel" in str(neighbor):
                 continue
-            nx_graph.add_edge(node, neighbor[0], label=neighbor[1])
+            label = get_edge_label_text(label, graph.get_assertions_of_nodes(node, neighbor))
+            nx_graph.add_edge(node, neighbor, label=label)
 
     pos = nx.spring_layout(graph, k=0.15, iterations=20)
     nx.draw(nx_graph, pos, with_labels=True, node_size=500)
@@ -285,39 +853,44 @@ def generate_system_graph_image_2(graph):
 
 
 def get_cycles_and_dag_paths(graph: UndirectedGraph):
+    cycles, topological_paths, topological_paths_for_cycles, cycle_assertions, _ = \
+        get_cycles_and_dag_paths_with_status(graph)
+    return cycles, topological_paths, topological_paths_for_cycles, cycle_assertions
 
-    valid_starting_nodes = get_valid_starting_nodes(graph)
-
-    cycles, used_edges, cycle_assertions = dfs_cycles(graph, valid_starting_nodes)
-    #print("Time (s)", time.process_time())
-
-    # results = dict()
-    #
-    # bts = list()
-    # bts_no_dups = set()
-    # for c in cycles:
-    #     #print(c)
-    #     lt_chain = list(map(lambda lt: lt.bt_owner.name, c))
-    #     bts.append(str(lt_chain))
-    # #print(bts)
-    # print(Counter(bts))
-    # print(len(Counter(bts)))
-    # bt_seqs = list([x for x in bts if not (x in bts_no_dups or bts_no_dups.add(x))])
-    # print(Counter(bt_seqs))
-    # print(len(bt_seqs))
-
-
-    dags = generate_dags(cycles, graph)
 
-    #print("Number of dags", len(dags))
+def get_cycles_and_dag_paths_with_status(graph: UndirectedGraph, time_budget=None):
+    # the AnalysisStatus tells whether the time budget cut the analysis short and which cycles are unknown
+    status = AnalysisStatus(time_budget if time_budget is not None else ANALYSIS_TIME_BUDGET_S)
 
-    topological_paths_for_cycles, topological_paths = generate_topological_paths(dags)
+    cycles = set()
+    cycle_assertions = dict()
+    topological_paths_for_cycles = []
+    topological_paths = set()
+    for cycle, assertions, dag, paths in iter_cycles_and_dag_paths(graph, status):
+        cycles.add(cycle)
+        cycle_assertions[cycle] = assertions
+        if dag is not None and not status.out_of_time():
+            add_topological_paths(cycle, dag, paths, topological_paths_for_cycles, topological_paths)
 
     if ENABLE_PRINT:
         print(cycles)
         print(topological_paths)
 
-    return cycles, topological_paths, topological_paths_for_cycles, cycle_assertions
+    return cycles, topological_paths, topological_paths_for_cycles, cycle_assertions, status
+
+
+def iter_cycles_and_dag_paths(graph: UndirectedGraph, status=None):
+    # yields (cycle, assertions, dag, topological paths) for each valid cycle as soon as it is found. the dag
+    # is None when an earlier cycle had the same one, the topological paths are its sorts, computed as they
+    # are read
+    status = status or AnalysisStatus()
+    seen_dags = set()
+    for cycle, _, assertions in iter_cycles(graph, get_valid_starting_nodes(graph), status):
+        dag = generate_dependency_dag(graph, cycle)
+        if add_new_dag(dag, seen_dags):
+            yield cycle, assertions, dag, iter_topological_paths(dag, status)
+        else:
+            yield cycle, assertions, None, iter(())
 
 
 def verify_cycles(topological_paths_for_cycles, system):
@@ -1,3 +1,5 @@
+import copy
+import weakref
 from enum import Enum
 
 import z3
@@ -8,11 +10,41 @@ class System:
         self.microservices = microservices
         self.non_conflict_units = non_conflict_units
 
+        # lookup indexes, kept up to date by Microservice.add_bt/remove_bt and
+        # BusinessTransaction.replace_remote_call
+        self.__bt_of_unit = dict()
+        self.__m_of_bt = dict()
+        self.__unit_of_label = dict()
+        for m in microservices:
+            m.set_system(self)
+
     def __str__(self):
         return f"System with: {self.microservices}"
 
+    def register_bt(self, m, bt):
+        self.__m_of_bt.setdefault(bt, m)
+        self.register_units(bt, bt.business_transaction_units)
+
+    def unregister_bt(self, bt):
+        if self.__m_of_bt.get(bt) is not None and bt not in self.__m_of_bt[bt].business_transactions:
+            del self.__m_of_bt[bt]
+        self.unregister_units(bt, bt.business_transaction_units)
+
+    def register_units(self, bt, units):
+        for u in units:
+            self.__bt_of_unit.setdefault(u, bt)
+
+    def unregister_units(self, bt, units):
+        for u in units:
+            if self.__bt_of_unit.get(u) is bt:
+                del self.__bt_of_unit[u]
+
     def get_bt_of_unit(self, unit):
 
+        if unit in self.__bt_of_unit:
+            return self.__bt_of_unit[unit]
+
+        # units added without going through the system, e.g. appended to a business transaction
         for m in self.microservices:
             for bt in m.business_transactions:
                 for u in bt.business_transaction_units:
@@ -23,38 +55,74 @@ class System:
 
     def get_bt_of_unit_label(self, unit_label):
 
-        for m in self.microservices:
-            for bt in m.business_transactions:
-                for u in bt.business_transaction_units:
-                    if u.label == unit_label:
-                        return bt
+        # labels are reassigned by the parser, the label index is rebuilt whenever it is stale
+        unit = self.__unit_of_label.get(unit_label)
+        if unit is None or unit.label != unit_label or unit not in self.__bt_of_unit:
+            self.__index_labels()
+            unit = self.__unit_of_label.get(unit_label)
 
-        return None
+        # units added without going through the system, e.g. appended to a business transaction
+        if unit is None:
+            self.__index_microservices()
+            self.__index_labels()
+            unit = self.__unit_of_label.get(unit_label)
+
+        if unit is None:
+            return None
+
+        return self.__bt_of_unit[unit]
 
     def get_m_of_bt(self, bt1):
 
-        for m in self.microservices:
-            for bt2 in m.business_transactions:
-                if bt1 == bt2:
-                    return m
+        # business transactions added without going through the system, e.g. appended to a microservice
+        if bt1 not in self.__m_of_bt:
+            self.__index_microservices()
 
-        return None
+        return self.__m_of_bt.get(bt1)
+
+    def __index_labels(self):
+        self.__unit_of_label = dict()
+        for u in self.__bt_of_unit:
+            self.__unit_of_label.setdefault(u.label, u)
+
+    def __index_microservices(self):
+        for m in self.microservices:
+            for bt in m.business_transactions:
+                self.register_bt(m, bt)
 
 
 class Microservice:
     def __init__(self, name, business_transactions):
         self.name = name
         self.business_transactions = business_transactions
+        self.system = None
+
+        for bt in business_transactions:
+            bt.set_microservice(self)
 
     def __str__(self):
         return f"Microservice: {self.name}, " \
                f"business_transactions: {self.business_transactions}"
 
+    def set_system(self, system):
+        # weak references, deep copies of units must not drag the whole system along
+        self.system = weakref.ref(system)
+        for bt in self.business_transactions:
+            system.register_bt(self, bt)
+
+    def get_system(self):
+        return self.system() if self.system else None
+
     def add_bt(self, bt):
         self.business_transactions.append(bt)
+        bt.set_microservice(self)
+        if self.get_system():
+            self.get_system().register_bt(self, bt)
 
     def remove_bt(self, bt):
         self.business_transactions.remove(bt)
+        if self.get_system():
+            self.get_system().unregister_bt(bt)
 
 
 class Table:
@@ -69,12 +137,8 @@ class Table:
     def column(self, column_name):
         for c in self.columns:
             if c.name == column_name:
-                if c.type == str:
-                    return z3.String(self.name + "." + c.name)
-                elif c.type == int:
-                    return z3.Int(self.name + "." + c.name)
-                elif c.type == bool:
-                    return z3.Bool(self.name + "." + c.name)
+                if c.type in (str, int, bool):
+                    return get_variable(self.name + "." + c.name, c.type)
         raise ValueError(f"column {column_name} not found")
 
 
@@ -95,6 +159,7 @@ class BusinessTransaction:
         self.name = name
         self.business_transaction_units = business_transaction_units
         self.params = params
+        self.microservice = None
 
         for u in business_transaction_units:
             u.set_bt_owner(self)
@@ -109,12 +174,24 @@ class BusinessTransaction:
             if not found_output:
                 raise ValueError(f"Output {o.name} not found")
 
+    def set_microservice(self, m):
+        self.microservice = weakref.ref(m)
+
+    def get_system(self):
+        m = self.microservice() if self.microservice else None
+        return m.get_system() if m else None
+
     def replace_remote_call(self, unit_to_replace, new_units):
         for u in new_units:
             u.set_bt_owner(self)
         replacement_index = self.business_transaction_units.index(unit_to_replace)
         self.business_transaction_units[replacement_index:replacement_index + 1] = new_units
 
+        system = self.get_system()
+        if system:
+            system.unregister_units(self, [unit_to_replace])
+            system.register_units(self, new_units)
+
     def __str__(self):
         return f"BusinessTransaction: {self.name}, " \
                f"business_transaction_units : {self.business_transaction_units}"
@@ -177,21 +254,38 @@ class LocalTransaction(BusinessTransactionUnit):
     def __repr__(self):
         return str(self)
 
+    def clone(self):
+        # a cheap copy, tables, parameters and predicates are shared, only the per owner state is new.
+        # operations reused from another local transaction keep that owner and are shared as they are
+        clone = copy.copy(self)
+        clone.ctx = dict()
+        clone.operations = []
+        for o in self.operations:
+            if o.lt_owner is self:
+                o = o.clone()
+                o.set_lt_owner(clone)
+            clone.operations.append(o)
+        return clone
+
     def get_ctx(self):
         if not self.ctx:
+            # only cached once complete, a failed lookup must fail again on the next call
+            ctx = dict()
             bt_input = self.bt_owner.get_input()
-            add_list_to_ctx(self.ctx, bt_input, self.bt_owner.name)
+            add_list_to_ctx(ctx, bt_input, self.bt_owner.name)
 
             last_lt_outputs = self.bt_owner.get_last_lt_outputs(self)
-            add_list_to_ctx(self.ctx, last_lt_outputs, self.label)
+            add_list_to_ctx(ctx, last_lt_outputs, self.label)
 
             for p in self.get_input():
-                if p.name not in self.ctx:
+                if p.name not in ctx:
                     raise ValueError(f"LT input {p.name} not found in context, bt: {self.bt_owner.name}")
 
                 #if p.name not in list(map(lambda i: i.name, bt_input)) and p.name not in list(map(lambda i: i.name, last_lt_outputs)):
                 #    raise ValueError(f"LT input {p.name} not found in context, bt: {self.bt_owner.name}")
 
+            self.ctx = ctx
+
         return self.ctx
 
     def get_output(self):
@@ -217,6 +311,20 @@ class RemoteBusinessTransaction(BusinessTransactionUnit):
         return str(self)
 
 
+class SavedTransaction(BusinessTransactionUnit):
+    # a unit reloaded from a saved graph, keeps only what the cycle search and the dags look at
+    def __init__(self, description, label, cloned):
+        super().__init__(cloned=cloned)
+        self.description = description
+        self.label = label
+
+    def __str__(self):
+        return self.description
+
+    def __repr__(self):
+        return str(self)
+
+
 class InternalBusinessTransaction(BusinessTransaction):
     def __init__(self, name, business_transaction_units, params=[]):
         super().__init__(name, business_transaction_units, params)
@@ -231,6 +339,7 @@ class Operation:
         self.table = table
         self.predicates = predicates
         self.ctx = dict()
+        self.predicate_assertion = None
 
         if not used_columns:
             self.used_columns = set(map(lambda c: c.name, self.table.columns))
@@ -252,21 +361,36 @@ class Operation:
     def set_lt_owner(self, lt):
         self.lt_owner = lt
 
+    def clone(self):
+        clone = copy.copy(self)
+        clone.ctx = dict()
+        clone.predicate_assertion = None
+        return clone
+
+    def get_predicate_assertion(self):
+        # the predicates instantiated with the operation context, built once per operation
+        if self.predicate_assertion is None:
+            self.predicate_assertion = self.predicates(self.get_operation_ctx())
+        return self.predicate_assertion
+
     def get_operation_ctx(self):
 
         if not self.ctx:
 
+            ctx = dict()
             lt_ctx = self.lt_owner.get_ctx()
             if lt_ctx:
-                self.ctx.update(lt_ctx.copy())
+                ctx.update(lt_ctx.copy())
 
             last_op_outputs = self.lt_owner.get_last_op_outputs(self)
-            add_list_to_ctx(self.ctx, last_op_outputs, self.name)
+            add_list_to_ctx(ctx, last_op_outputs, self.name)
 
             for p in self.get_input():
-                if p.name not in self.ctx:
+                if p.name not in ctx:
                     raise ValueError(f"Operation input {p.name} not found in context, {self.name}")
 
+            self.ctx = ctx
+
         return self.ctx
 
 
@@ -291,15 +415,28 @@ class OperationType(Enum):
 
 def add_list_to_ctx(ctx, list, label):
     for i in list:
-        if i.type == int:
-            ctx[i.name] = z3.Int(i.name + "_" + label)
-        elif i.type == str:
-            ctx[i.name] = z3.String(i.name + "_" + label)
-        elif i.type == bool:
-            ctx[i.name] = z3.Bool(i.name + "_" + label)
+        if i.type in (int, str, bool):
+            ctx[i.name] = get_variable(i.name + "_" + label, i.type)
         else:
             raise NotImplementedError("")
 
 
+# z3 constants of columns and context variables by name and type, so each is only built once per analysis
+_variables = dict()
+_variable_constructors = {int: z3.Int, str: z3.String, bool: z3.Bool}
+
+
+def get_variable(name, type):
+    variable = _variables.get((name, type))
+    if variable is None:
+        variable = _variable_constructors[type](name)
+        _variables[(name, type)] = variable
+    return variable
+
+
+def clear_variables():
+    _variables.clear()
+
+
 def flatten(l):
-    return [item for sublist in l for item in sublist]
\ No newline at end of file
+    return [item for sublist in l for item in sublist]
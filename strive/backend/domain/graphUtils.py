@@ -1,9 +1,16 @@
+from array import array
+
+
 class UndirectedGraph:
     def __init__(self):
         self.__assertions = {}
+        # node -> {neighbour: label}
         self.__nodes = {}
         self.__business_sequences = []
+        # node -> first business sequence holding it
+        self.__business_sequence_of = {}
         self.__business_sequences_data_dependencies = {}
+        self.__frozen = None
 
     def nodes(self):
         return self.__nodes
@@ -13,51 +20,239 @@ class UndirectedGraph:
 
     def add_node(self, node):
         if node not in self.__nodes:
-            self.__nodes[node] = set()
+            self.__frozen = None
+            self.__nodes[node] = {}
 
     def add_edge(self, node1, node2, label, assertions=[]):
         self.add_node(node1)
         self.add_node(node2)
         if node1 in self.__nodes and node2 in self.__nodes:
-            self.__nodes[node1].add((node2, label))
-            self.__nodes[node2].add((node1, label))
+            self.__frozen = None
+            self.__nodes[node1][node2] = label
+            self.__nodes[node2][node1] = label
             self.__assertions[(node1, node2)] = assertions
             self.__assertions[(node2, node1)] = assertions
 
     def add_business_sequence(self, nodes):
+        self.__frozen = None
         self.__business_sequences.append(nodes)
+        for node in nodes:
+            self.__business_sequence_of.setdefault(node, nodes)
 
     def get_business_sequence_of(self, node):
-        for s in self.__business_sequences:
-            if node in s:
-                return s
+        return self.__business_sequence_of.get(node)
 
     def remove_edge(self, node1, node2):
         if node1 in self.__nodes and node2 in self.__nodes:
-            for neighbour, label in set(self.__nodes[node1]):
-                if neighbour == node2:
-                    self.__nodes[node1].discard((neighbour, label))
-            for neighbour, label in set(self.__nodes[node2]):
-                if neighbour == node1:
-                    self.__nodes[node2].discard((neighbour, label))
+            self.__frozen = None
+            self.__nodes[node1].pop(node2, None)
+            self.__nodes[node2].pop(node1, None)
 
     def get_neighbours(self, node):
+        return list(self.iter_neighbours(node))
+
+    def iter_neighbours(self, node):
+        # (neighbour, label) pairs without copying, the graph must not change while iterating
         if node in self.__nodes:
-            return list(self.__nodes[node])
+            return iter(self.__nodes[node].items())
         else:
-            return []
+            return iter(())
 
     def __str__(self):
         return str(self.__nodes)
 
     def has_edge(self, node1, node2):
 
-        if node1 in self.__nodes and node2 in self.__nodes:
-            for neighbour, label in self.__nodes[node1]:
-                if neighbour == node2:
-                    return True
+        if node1 in self.__nodes:
+            return node2 in self.__nodes[node1]
 
         return False
 
     def get_assertions_of_nodes(self, node1, node2):
-        return self.__assertions[(node1, node2)]
\ No newline at end of file
+        return self.__assertions[(node1, node2)]
+
+    def freeze(self):
+        # read-only snapshot for the cycle search, rebuilt after any change to the graph
+        if self.__frozen is None:
+            self.__frozen = FrozenGraph(self)
+        return self.__frozen
+
+
+class FrozenGraph:
+    # array backed snapshot of an UndirectedGraph, nodes are integer ids in [0, len(nodes))
+    def __init__(self, graph: UndirectedGraph):
+        self.index = dict.fromkeys(graph.nodes())
+        for business_sequence in graph.business_sequences():
+            self.index.update((node, None) for node in business_sequence if node not in self.index)
+        self.nodes = list(self.index)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+
+        self.labels = [node.label for node in self.nodes]
+        self.order = [get_label_order(node) for node in self.nodes]
+        self.cloned = bytearray(bool(node.cloned) for node in self.nodes)
+
+        # bt owners by identity and by name, as compared by the cycle validation
+        owner_ids = {}
+        owner_name_ids = {}
+        self.owner = array("i", (owner_ids.setdefault(node.bt_owner, len(owner_ids)) for node in self.nodes))
+        self.owner_name = array("i", (owner_name_ids.setdefault(getattr(node.bt_owner, "name", None),
+                                                                len(owner_name_ids)) for node in self.nodes))
+
+        # CSR adjacency, the neighbours of node i are neighbours[offsets[i]:offsets[i + 1]]
+        self.edge_label_names = []
+        edge_label_ids = {}
+        self.offsets = array("i", [0])
+        self.neighbours = array("i")
+        self.edge_labels = array("i")
+        self.edge_assertions = []
+        for node in self.nodes:
+            for neighbour, label in graph.iter_neighbours(node):
+                if label not in edge_label_ids:
+                    edge_label_ids[label] = len(self.edge_label_names)
+                    self.edge_label_names.append(label)
+                self.neighbours.append(self.index[neighbour])
+                self.edge_labels.append(edge_label_ids[label])
+                self.edge_assertions.append(graph.get_assertions_of_nodes(node, neighbour))
+            self.offsets.append(len(self.neighbours))
+
+        # sequences with the same nodes share an id, a node belongs to the first sequence holding it
+        self.sequences = []
+        self.sequence_members = []
+        sequence_ids = {}
+        self.sequence_of = array("i", [-1] * len(self.nodes))
+        self.position = array("i", [-1] * len(self.nodes))
+        for business_sequence in graph.business_sequences():
+            ids = tuple(self.index[node] for node in business_sequence)
+            if ids not in sequence_ids:
+                sequence_ids[ids] = len(self.sequences)
+                self.sequences.append(array("i", ids))
+                self.sequence_members.append(frozenset(ids))
+            for position, i in enumerate(ids):
+                if self.sequence_of[i] == -1:
+                    self.sequence_of[i] = sequence_ids[ids]
+                    self.position[i] = position
+
+        self.cycle_components = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get_cycle_components(self):
+        if self.cycle_components is None:
+            self.cycle_components = get_cycle_components(self)
+        return self.cycle_components
+
+    def get_business_sequence_of(self, i):
+        if self.sequence_of[i] == -1:
+            return None
+        return self.sequences[self.sequence_of[i]]
+
+    def in_business_sequence_of(self, i, node):
+        return self.sequence_of[node] != -1 and i in self.sequence_members[self.sequence_of[node]]
+
+    def iter_neighbours(self, i):
+        for k in range(self.offsets[i], self.offsets[i + 1]):
+            yield self.neighbours[k], self.edge_labels[k]
+
+    def get_assertions_of_nodes(self, node1, node2):
+        # takes node objects, like UndirectedGraph
+        i, j = self.index[node1], self.index[node2]
+        for k in range(self.offsets[i], self.offsets[i + 1]):
+            if self.neighbours[k] == j:
+                return self.edge_assertions[k]
+        raise KeyError((node1, node2))
+
+
+def get_cycle_components(graph: FrozenGraph):
+    # (component, on_cycle), the component id of each node, -1 when no cycle goes through it, and whether
+    # each adjacency entry can be part of a cycle. a cycle returns to the business sequence it started from,
+    # so with sequences contracted it is a circuit, which never uses a bridge and stays in a 2-edge-connected
+    # component of the contracted multigraph
+    n = len(graph.nodes)
+
+    # contracted vertex of each node, sequences sharing a node are merged
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for sequence in graph.sequences:
+        for i in sequence[1:]:
+            parent[find(i)] = find(sequence[0])
+    vertex = [find(i) for i in range(n)]
+
+    # edges between different vertices, edges inside a vertex are never bridges
+    edge_ids = {}
+    adjacency = {}
+    for i in range(n):
+        for k in range(graph.offsets[i], graph.offsets[i + 1]):
+            j = graph.neighbours[k]
+            if i < j and vertex[i] != vertex[j]:
+                edge_ids[(i, j)] = len(edge_ids)
+                adjacency.setdefault(vertex[i], []).append((vertex[j], edge_ids[(i, j)]))
+                adjacency.setdefault(vertex[j], []).append((vertex[i], edge_ids[(i, j)]))
+
+    # bridges by lowlink, parallel edges are told apart by edge id
+    bridges = set()
+    discovery = {}
+    low = {}
+    for root in adjacency:
+        if root in discovery:
+            continue
+        discovery[root] = low[root] = len(discovery)
+        stack = [(root, -1, iter(adjacency[root]))]
+        while stack:
+            v, via, edges = stack[-1]
+            for w, e in edges:
+                if e == via:
+                    continue
+                if w in discovery:
+                    low[v] = min(low[v], discovery[w])
+                else:
+                    discovery[w] = low[w] = len(discovery)
+                    stack.append((w, e, iter(adjacency[w])))
+                    break
+            else:
+                stack.pop()
+                if stack:
+                    u = stack[-1][0]
+                    low[u] = min(low[u], low[v])
+                    if low[v] > discovery[u]:
+                        bridges.add(via)
+
+    # components over the remaining edges, vertices left without edges are in none
+    vertex_component = {}
+    components = 0
+    for root in adjacency:
+        if root in vertex_component or all(e in bridges for _, e in adjacency[root]):
+            continue
+        vertex_component[root] = components
+        components += 1
+        to_visit = [root]
+        while to_visit:
+            v = to_visit.pop()
+            for w, e in adjacency[v]:
+                if e not in bridges and w not in vertex_component:
+                    vertex_component[w] = vertex_component[root]
+                    to_visit.append(w)
+
+    component = array("i", (vertex_component.get(vertex[i], -1) for i in range(n)))
+    on_cycle = bytearray(len(graph.neighbours))
+    for i in range(n):
+        for k in range(graph.offsets[i], graph.offsets[i + 1]):
+            j = graph.neighbours[k]
+            if vertex[i] == vertex[j]:
+                on_cycle[k] = component[i] != -1
+            else:
+                on_cycle[k] = edge_ids[(min(i, j), max(i, j))] not in bridges
+    return component, on_cycle
+
+
+def get_label_order(node):
+    try:
+        return int(node.label)
+    except (TypeError, ValueError):
+        return None
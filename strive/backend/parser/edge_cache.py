@@ -0,0 +1,109 @@
+import hashlib
+import sqlite3
+
+import z3
+
+from parser.smt_utils import get_input_constraints, serialize_assertions, deserialize_assertions, Condition, \
+    get_free_constants
+
+
+class EdgeCache:
+    # check_edge verdicts stored on disk, keyed by a fingerprint of everything check_edge looks at. variables
+    # named after unit labels are stored renamed after the business transaction and position of the unit, so
+    # renumbering the labels, e.g. by adding a business transaction before others, keeps the entries valid.
+    # changing a unit's operations, predicates, parameters or position in its business transaction, or the
+    # name of the business transaction, misses for the pairs of that unit and of the units after it
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS edge_checks "
+                                "(fingerprint TEXT PRIMARY KEY, edge INTEGER, assertions TEXT)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get(self, fingerprint, suffixes=None):
+        # suffixes as given by get_label_suffixes for the pair, the stored variables are renamed back with them
+        row = self.connection.execute("SELECT edge, assertions FROM edge_checks WHERE fingerprint = ?",
+                                      (fingerprint,)).fetchone()
+        if row is None:
+            return None
+
+        edge = None if row[0] is None else bool(row[0])
+        assertions = deserialize_assertions(row[1])
+        if suffixes:
+            assertions = rename_variables(assertions, {other: suffix for suffix, other in suffixes.items()})
+        return edge, Condition(assertions)
+
+    def put(self, fingerprint, edge, assertions, suffixes=None):
+        if suffixes:
+            assertions = rename_variables(getattr(assertions, "assertions", assertions), suffixes)
+        self.connection.execute("INSERT OR REPLACE INTO edge_checks VALUES (?, ?, ?)",
+                                (fingerprint, None if edge is None else int(edge), serialize_assertions(assertions)))
+
+
+def get_label_suffixes(lt1, lt2):
+    # variable suffixes of the unit labels of both business transactions, with the name of the business
+    # transaction and the position of the unit in it that replace them
+    suffixes = dict()
+    for lt in [lt1, lt2]:
+        bt = lt.bt_owner
+        if bt is None:
+            continue
+        for i, u in enumerate(bt.business_transaction_units):
+            suffixes[f"_{u.label}"] = f"_{bt.name}#{i}"
+    return suffixes
+
+
+def rename_variables(assertions, suffixes):
+    renaming = []
+    for c in get_free_constants(assertions):
+        name = c.decl().name()
+        for suffix, other in suffixes.items():
+            if name.endswith(suffix):
+                renaming.append((c, z3.Const(name[:-len(suffix)] + other, c.sort())))
+                break
+
+    if not renaming:
+        return list(assertions)
+    return [z3.substitute(a, *renaming) if z3.is_expr(a) else a for a in assertions]
+
+
+def get_edge_fingerprint(lt1, lt2, suffixes=None):
+    # returns None when the pair can not be fingerprinted, e.g. an operation context is incomplete
+    try:
+        parts = [str(lt1.bt_owner == lt2.bt_owner)]
+        for lt in [lt1, lt2]:
+            parts.append(get_lt_fingerprint(lt, suffixes))
+    except Exception:
+        return None
+
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def get_lt_fingerprint(lt, suffixes=None):
+    parts = []
+    for o in lt.operations:
+        parts.append(repr((o.table.name,
+                           sorted((c.name, c.type.__name__) for c in o.table.columns),
+                           sorted(o.used_columns),
+                           o.type.value,
+                           sorted(get_params_fingerprint(o.params)))))
+        if o.predicates:
+            parts.append(serialize_assertions(rename_variables([o.get_predicate_assertion()], suffixes or {})))
+        else:
+            parts.append("no predicates")
+
+    parts.append(repr(sorted(get_params_fingerprint(lt.params))))
+    parts.append(serialize_assertions(rename_variables(get_input_constraints(lt), suffixes or {})))
+    return "\n".join(parts)
+
+
+def get_params_fingerprint(params):
+    return [(type(p).__name__, p.name, p.type.__name__) for p in params]
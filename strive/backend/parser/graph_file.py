@@ -0,0 +1,82 @@
+import json
+
+from domain.domain_model import BusinessTransaction, SavedTransaction
+from domain.graphUtils import UndirectedGraph
+from parser.smt_utils import serialize_assertions, deserialize_assertions
+
+GRAPH_FILE_VERSION = 2
+
+
+def save_graph(graph: UndirectedGraph, path):
+    # JSON, plain data only: node ids, adjacency of the frozen graph and assertions as SMT-LIB text, so loading a
+    # shared file runs no code
+    frozen = graph.freeze()
+
+    assertion_ids = {}
+    assertions = []
+    edge_assertions = []
+    for edge_assertion in frozen.edge_assertions:
+        # both directions of an edge share the same list
+        if id(edge_assertion) not in assertion_ids:
+            assertion_ids[id(edge_assertion)] = len(assertions)
+            assertions.append(serialize_assertions(edge_assertion))
+        edge_assertions.append(assertion_ids[id(edge_assertion)])
+
+    owner_names = {}
+    for i, node in enumerate(frozen.nodes):
+        owner_names.setdefault(frozen.owner[i], getattr(node.bt_owner, "name", None))
+
+    data = {
+        "version": GRAPH_FILE_VERSION,
+        "node_count": len(graph.nodes()),
+        "descriptions": [str(node) for node in frozen.nodes],
+        "labels": frozen.labels,
+        "cloned": list(frozen.cloned),
+        "owner": list(frozen.owner),
+        "owner_names": [owner_names[i] for i in range(len(owner_names))],
+        "offsets": list(frozen.offsets),
+        "neighbours": list(frozen.neighbours),
+        "edge_labels": list(frozen.edge_labels),
+        "edge_label_names": frozen.edge_label_names,
+        "edge_assertions": edge_assertions,
+        "assertions": assertions,
+        "sequences": [[frozen.index[node] for node in s] for s in graph.business_sequences()],
+    }
+
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def load_graph(path):
+    # nodes come back as SavedTransaction, owned by business transactions with the saved names
+    with open(path) as f:
+        data = json.load(f)
+
+    if data.get("version") != GRAPH_FILE_VERSION:
+        raise ValueError(f"Unsupported graph file version {data.get('version')}")
+
+    owner = data["owner"]
+    owners = [BusinessTransaction(name, []) for name in data["owner_names"]]
+    nodes = []
+    for i, (description, label) in enumerate(zip(data["descriptions"], data["labels"])):
+        node = SavedTransaction(description, label, bool(data["cloned"][i]))
+        node.set_bt_owner(owners[owner[i]])
+        nodes.append(node)
+
+    graph = UndirectedGraph()
+    for node in nodes[:data["node_count"]]:
+        graph.add_node(node)
+
+    assertions = [deserialize_assertions(a) for a in data["assertions"]]
+    offsets, neighbours, edge_labels = data["offsets"], data["neighbours"], data["edge_labels"]
+    for i, node in enumerate(nodes):
+        for k in range(offsets[i], offsets[i + 1]):
+            neighbour = nodes[neighbours[k]]
+            if not graph.has_edge(node, neighbour):
+                graph.add_edge(node, neighbour, data["edge_label_names"][edge_labels[k]],
+                               assertions[data["edge_assertions"][k]])
+
+    for s in data["sequences"]:
+        graph.add_business_sequence([nodes[i] for i in s])
+
+    return graph
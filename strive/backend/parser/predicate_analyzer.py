@@ -0,0 +1,101 @@
+import z3
+
+# sorts with infinitely many values, where a set of equalities and disequalities is sat unless it
+# merges two different values or the two sides of a disequality
+INFINITE_SORTS = (z3.Z3_INT_SORT, z3.Z3_REAL_SORT, z3.Z3_SEQ_SORT)
+
+
+def decide_conjunction(assertions):
+    # z3.sat or z3.unsat for conjunctions of equalities, disequalities and boolean literals over
+    # constants and values, None when anything else is involved and z3 has to decide
+
+    # union-find over ast ids, classes holding a value are marked by their root
+    parent = dict()
+    valued = set()
+    disequalities = []
+
+    def find(expr):
+        root = expr.get_id()
+        if root not in parent:
+            parent[root] = root
+            if is_value(expr):
+                valued.add(root)
+        while parent[root] != root:
+            root = parent[root]
+        return root
+
+    def union(a, b):
+        root_a, root_b = find(a), find(b)
+        if root_a == root_b:
+            return True
+        if root_a in valued and root_b in valued:
+            return False
+        parent[root_a] = root_b
+        if root_a in valued:
+            valued.add(root_b)
+        return True
+
+    literals = list(assertions)
+    while literals:
+        literal = literals.pop()
+        if not z3.is_expr(literal):
+            if literal is True:
+                continue
+            if literal is False:
+                return z3.unsat
+            return None
+
+        if z3.is_true(literal):
+            continue
+        if z3.is_false(literal):
+            return z3.unsat
+        if z3.is_and(literal):
+            literals.extend(literal.children())
+            continue
+
+        if z3.is_eq(literal) and is_term(literal.arg(0)) and is_term(literal.arg(1)):
+            if not union(literal.arg(0), literal.arg(1)):
+                return z3.unsat
+        elif z3.is_distinct(literal) and all(is_term(a) and is_infinite(a) for a in literal.children()):
+            disequalities.extend((a, b) for i, a in enumerate(literal.children()) for b in literal.children()[i + 1:])
+        elif z3.is_not(literal) and z3.is_eq(literal.arg(0)) and \
+                all(is_term(a) and is_infinite(a) for a in literal.arg(0).children()):
+            disequalities.append((literal.arg(0).arg(0), literal.arg(0).arg(1)))
+        elif is_boolean_constant(literal):
+            if not union(literal, z3.BoolVal(True)):
+                return z3.unsat
+        elif z3.is_not(literal) and is_boolean_constant(literal.arg(0)):
+            if not union(literal.arg(0), z3.BoolVal(False)):
+                return z3.unsat
+        else:
+            return None
+
+    for a, b in disequalities:
+        if find(a) == find(b):
+            return z3.unsat
+
+    return z3.sat
+
+
+def is_value(expr):
+    return z3.is_int_value(expr) or z3.is_rational_value(expr) or z3.is_string_value(expr) or \
+           z3.is_true(expr) or z3.is_false(expr)
+
+
+def is_constant(expr):
+    return z3.is_const(expr) and expr.decl().kind() == z3.Z3_OP_UNINTERPRETED
+
+
+def is_boolean_constant(expr):
+    return is_constant(expr) and z3.is_bool(expr)
+
+
+def is_infinite(expr):
+    return expr.sort().kind() in INFINITE_SORTS
+
+
+def is_term(expr):
+    # constants and values of the sorts the analyzer handles, bool equalities only against values
+    if not (is_constant(expr) or is_value(expr)):
+        return False
+    return is_infinite(expr) or z3.is_bool(expr)
@@ -1,19 +1,177 @@
-import inspect
 import itertools
-import re
+from collections import OrderedDict
+from collections.abc import Sequence
 
 from z3 import *
 
 from domain.domain_model import *
 from domain.graphUtils import UndirectedGraph
+from parser.predicate_analyzer import decide_conjunction
 
 
-def check_cycle_sat(cycle, graph: UndirectedGraph):
+CYCLE_SAT_CACHE_SIZE = 10000
+PREDICATE_ANALYZER = True
+SOLVER_TIMEOUT_MS = None
+
+
+def set_solver_timeout(timeout_ms):
+    global SOLVER_TIMEOUT_MS
+    SOLVER_TIMEOUT_MS = timeout_ms
+
+
+def get_solver():
+    # queries that run out of time are unknown
     solver = z3.Solver()
+    if SOLVER_TIMEOUT_MS:
+        solver.set("timeout", SOLVER_TIMEOUT_MS)
+    return solver
+
+
+def set_predicate_analyzer(enabled):
+    global PREDICATE_ANALYZER
+    PREDICATE_ANALYZER = enabled
+
+
+class Condition(Sequence):
+    # the simplified assertions of an edge or a cycle, only simplified when read, e.g. printed or
+    # checked as part of a cycle
+    def __init__(self, assertions):
+        self.assertions = assertions
+        self.simplified = None
+
+    def get_simplified(self):
+        if self.simplified is None:
+            self.simplified = [simplify(a) for a in self.assertions]
+        return self.simplified
+
+    def __getitem__(self, index):
+        return self.get_simplified()[index]
+
+    def __len__(self):
+        return len(self.assertions)
+
+    def __str__(self):
+        return str(self.get_simplified())
+
+    def __repr__(self):
+        return str(self)
+
+    def witness(self):
+        return get_witness(self.assertions)
+
+
+def get_witness(assertions):
+    # a model of the assertions, None when they are not sat
+    solver = get_solver()
+    for a in assertions:
+        solver.add(a)
+    if solver.check() != sat:
+        return None
+    return solver.model()
+
+
+def presolve(solver):
+    # the verdict for equality only conjunctions, decided without z3, None when z3 has to check
+    if PREDICATE_ANALYZER:
+        return decide_conjunction(solver.assertions())
+    return None
+
+
+class CycleSatCache:
+    # least recently used check_cycle_sat results, keyed by the ids of the unique cycle assertions.
+    # entries hold the assertions so their ids are not reused while cached
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, result, assertions):
+        if self.size <= 0:
+            return
+        self.entries[key] = (result, assertions)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+cycle_sat_cache = CycleSatCache(CYCLE_SAT_CACHE_SIZE)
+
+
+def set_cycle_sat_cache_size(size):
+    global CYCLE_SAT_CACHE_SIZE
+    CYCLE_SAT_CACHE_SIZE = size
+    cycle_sat_cache.size = size
+    while len(cycle_sat_cache.entries) > max(size, 0):
+        cycle_sat_cache.entries.popitem(last=False)
+
+
+def check_cycle_sat(cycle, graph: UndirectedGraph):
+    unique_assertions = get_unique_cycle_assertions(cycle, graph)
+
+    key = None
+    if CYCLE_SAT_CACHE_SIZE > 0 and all(is_expr(a) for a in unique_assertions):
+        key = frozenset(a.get_id() for a in unique_assertions)
+        cached = cycle_sat_cache.get(key)
+        if cached is not None:
+            return cached
+
+    solver = get_solver()
+    simplified_assertions = add_cycle_assertions(solver, cycle, graph, unique_assertions)
+
+    result = presolve(solver)
+    if result is None:
+        result = solver.check()
+
+    # None when unknown, the cycle is kept and the next check may have more time
+    verdict = None if result == unknown else result == sat
+    if key is not None and verdict is not None:
+        cycle_sat_cache.put(key, (verdict, simplified_assertions), list(unique_assertions))
+    return verdict, simplified_assertions
+
+
+def get_cycle_unsat_core(cycle, graph: UndirectedGraph):
+    # ids of a minimal set of the cycle assertions that is unsat, None when the cycle is not unsat
+    solver = get_solver()
+    solver.set("core.minimize", True)
+    tracked = dict()
+    for a in get_unique_cycle_assertions(cycle, graph):
+        if is_expr(a):
+            indicator = z3.Bool(f"__cycle_assertion_{a.get_id()}")
+            solver.assert_and_track(a, indicator)
+            tracked[indicator.get_id()] = a.get_id()
+
+    if solver.check() != unsat:
+        return None
+
+    return frozenset(tracked[c.get_id()] for c in solver.unsat_core())
+
+
+def get_unique_cycle_assertions(cycle, graph: UndirectedGraph):
     unique_assertions = set()
     for n1, n2 in list(zip(cycle, cycle[1:])):
         for a in graph.get_assertions_of_nodes(n1, n2):
             unique_assertions.add(a)
+    return unique_assertions
+
+
+def add_cycle_assertions(solver, cycle, graph: UndirectedGraph, unique_assertions=None):
+    # adds the unique assertions of the cycle edges as one conjunction, returns their condition
+    if unique_assertions is None:
+        unique_assertions = get_unique_cycle_assertions(cycle, graph)
 
     #for a in unique_assertions:
     #    solver.add(a)
@@ -22,32 +180,67 @@ def check_cycle_sat(cycle, graph: UndirectedGraph):
     solver.add(combined_assertions)
     #print("TEST", combined_assertions)
 
-    #for a in solver.assertions():
-    #    print("simplifying")
-    #    print(simplify(simplify(a)))
-    #    print("before", a)
+    return Condition(list(solver.assertions()))
 
 
-    simplified_assertions = list(set([simplify(assertion) for assertion in solver.assertions()]))
+def check_edge(lt1, lt2):
+    edge_assertions = get_edge_assertions(lt1, lt2)
+    if edge_assertions is None:
+        return False, []
 
-    #print("TEST2", simplified_assertions)
+    solver = get_solver()
+    for a in edge_assertions:
+        solver.add(a)
 
-    result = solver.check()
-    if result==sat:
-        print(solver.model())
-    return result == sat, simplified_assertions
+    result = presolve(solver)
+    if result is None:
+        result = solver.check()
 
+    return get_edge_verdict(result), Condition(list(solver.assertions()))
 
-def check_edge(lt1, lt2):
 
-    solver = z3.Solver()
+def check_edges_batch(pairs, batch_size):
+    # check_edge for many pairs, batch_size pairs share a solver. each pair is asserted behind its own
+    # guard literal and decided by checking under that guard, so what the solver learns is reused
+    results = []
+    solver = None
+    for i, (lt1, lt2) in enumerate(pairs):
+        edge_assertions = get_edge_assertions(lt1, lt2)
+        if edge_assertions is None:
+            results.append((False, []))
+            continue
+
+        # the same assertions a fresh solver of check_edge would hold
+        edge_assertions = [a if is_expr(a) else BoolVal(a) for a in edge_assertions]
+        result = decide_conjunction(edge_assertions) if PREDICATE_ANALYZER else None
+        if result is None:
+            if solver is None or i % batch_size == 0:
+                solver = get_solver()
+            guard = Bool(f"__edge_guard_{i}")
+            solver.add(Implies(guard, And(edge_assertions)))
+            result = solver.check(guard)
+
+        results.append((get_edge_verdict(result), Condition(edge_assertions)))
+    return results
+
+
+def get_edge_verdict(result):
+    # None when unknown
+    if result == sat:
+        return True
+    elif result == unsat:
+        return False
+    return None
+
+
+def get_edge_assertions(lt1, lt2):
+    # the assertions check_edge decides for the pair, None when no pair of operations can conflict
     assertions = []
 
     # an edge can be present if at least a pair of operations have an edge
     for o1, o2 in itertools.product(lt1.operations, lt2.operations):
 
         var_dep = False
-        intersection = []
         if lt1.bt_owner == lt2.bt_owner:
             o1_output = {p.name for p in o1.get_output()}
             o2_input = {p.name for p in o2.get_input()}
@@ -67,69 +260,66 @@ def check_edge(lt1, lt2):
         #print("lt1", lt1, "lt2", lt2)
         #print("var_dep", var_dep, "; table_dep", table_dep)
 
-        # the following code is to check if all variables of the interception are being used
-        op_lambdas = ""
-        if o1.predicates:
-            op_lambdas = inspect.getsource(o1.predicates)
-
-        if o2.predicates:
-            op_lambdas += inspect.getsource(o2.predicates)
-
-        matches = re.findall(r'ctx\["(.*?)"]', op_lambdas)
-        used = True
-        for m in matches:
-            if m in intersection:
-                used = True
-                intersection.remove(m)
-
-        #if len(intersection) > 0 and used:
-        #    print(f"WARNING: not all variables in interception are being used")
-
-        if not used and not table_dep:
-            continue
-
-        ctx_1 = o1.get_operation_ctx()
-        ctx_2 = o2.get_operation_ctx()
+        # the contexts are built even without predicates, a missing input is an error
+        o1.get_operation_ctx()
+        o2.get_operation_ctx()
 
         if o1.predicates and o2.predicates:
-            assertions.append(z3.And(o1.predicates(ctx_1), o2.predicates(ctx_2)))
+            assertions.append(z3.And(o1.get_predicate_assertion(), o2.get_predicate_assertion()))
         elif o1.predicates:
-            assertions.append(o1.predicates(ctx_1))
+            assertions.append(o1.get_predicate_assertion())
         elif o2.predicates:
-            assertions.append(o2.predicates(ctx_2))
+            assertions.append(o2.get_predicate_assertion())
         else:
             #TODO YOOOOO test True vs False
             assertions.append(True)
 
     if len(assertions) == 0:
-        return False, []
-
-    if len(assertions) > 1:
-        solver.add(z3.And(assertions))
-    else:
-        solver.add(assertions)
-
-    past_lts_1 = lt1.bt_owner.get_lts_before_given_lt(lt1)
-    past_lts_2 = lt2.bt_owner.get_lts_before_given_lt(lt2)
+        return None
+
+    edge_assertions = [z3.And(assertions) if len(assertions) > 1 else assertions[0]]
+    for curr_lt in [lt1, lt2]:
+        edge_assertions.extend(get_input_constraints(curr_lt))
+    return edge_assertions
+
+
+def get_input_constraints(curr_lt):
+    # predicates of past operations in the business transaction whose outputs are inputs of curr_lt
+    constraints = []
+    curr_lt_input = set(map(lambda p: p.name, curr_lt.get_input()))
+    for lt in curr_lt.bt_owner.get_lts_before_given_lt(curr_lt):
+        for o in lt.operations:
+            past_o_output = set(map(lambda p: p.name, o.get_output()))
+            intersection = past_o_output.intersection(curr_lt_input)
+            if intersection and o.predicates:
+                constraints.append(o.get_predicate_assertion())
+    return constraints
+
+
+def get_free_constants(assertions):
+    # uninterpreted constants of the assertions, by ast id
+    constants = dict()
+    seen = set()
+    to_visit = [a for a in assertions if is_expr(a)]
+    while to_visit:
+        expr = to_visit.pop()
+        if expr.get_id() in seen:
+            continue
+        seen.add(expr.get_id())
+        if is_const(expr) and expr.decl().kind() == Z3_OP_UNINTERPRETED:
+            constants[expr.get_id()] = expr
+        to_visit.extend(expr.children())
+    return list(constants.values())
 
-    for past_lts, curr_lt in [(past_lts_1, lt1), (past_lts_2, lt2)]:
-        for lt in past_lts:
-            for o in lt.operations:
-                past_o_output = set(map(lambda p: p.name, o.get_output()))
-                curr_lt_input = set(map(lambda p: p.name, curr_lt.get_input()))
-                intersection = past_o_output.intersection(curr_lt_input)
-                if intersection and o.predicates:
-                    solver.add(o.predicates(o.get_operation_ctx()))
 
-    result = solver.check()
+def serialize_assertions(assertions):
+    # SMT-LIB text, so assertions can cross process boundaries and z3 contexts. a Condition is written
+    # unsimplified, simplifying is left to whoever reads it
+    solver = z3.Solver()
+    for a in getattr(assertions, "assertions", assertions):
+        solver.add(a)
+    return solver.sexpr()
 
-    simplified_assertions = [simplify(assertion) for assertion in solver.assertions()]
 
-    #print(solver.assertions())
-    if result == sat:
-        #model = solver.model()
-        return True, simplified_assertions
-    elif result == unsat:
-        return False, simplified_assertions
-    else:
-        return None, simplified_assertions
+def deserialize_assertions(smt2):
+    return list(z3.parse_smt2_string(smt2))
@@ -1,13 +1,40 @@
 import copy
 import itertools
+import multiprocessing
+
+import z3
 
 from domain.domain_model import *
 from domain.graphUtils import *
-from parser.smt_utils import check_edge
+from parser.edge_cache import EdgeCache, get_edge_fingerprint, get_label_suffixes
+from parser.smt_utils import check_edge, check_edges_batch, serialize_assertions, deserialize_assertions, \
+    get_free_constants, Condition
 
 OPERATION_PREDICATE = True
 DATA_DEP = True
 PARALLEL_EXPANSION = True
+DERIVE_CLONE_EDGES = True
+EDGE_CHECK_WORKERS = 1
+EDGE_CHECK_BATCH_SIZE = 64
+EDGE_CACHE_PATH = None
+UNKNOWN_EDGE_LABEL_PREFIX = "unknown "
+CONDITION_EDGE_LABEL_PREFIX = "z3 condition "
+
+
+def set_edge_check_workers(workers):
+    global EDGE_CHECK_WORKERS
+    EDGE_CHECK_WORKERS = workers
+
+
+def set_edge_check_batch_size(size):
+    # pairs sharing a solver, 0 checks each pair in its own solver
+    global EDGE_CHECK_BATCH_SIZE
+    EDGE_CHECK_BATCH_SIZE = size
+
+
+def set_edge_cache_path(path):
+    global EDGE_CACHE_PATH
+    EDGE_CACHE_PATH = path
 
 
 def get_ops_edge_label(o1, o2):
@@ -20,21 +47,41 @@ def get_ops_edge_label(o1, o2):
     return None
 
 
+def get_edge_label(edge, label):
+    # edges z3 could not decide, e.g. after a solver timeout, are kept and tagged
+    if edge is None:
+        return UNKNOWN_EDGE_LABEL_PREFIX + label
+    return label
+
+
+def is_unknown_edge_label(label):
+    return label.startswith(UNKNOWN_EDGE_LABEL_PREFIX)
+
+
+def get_condition_label(assertions, condition_labels):
+    # edges with the same condition share a label numbered in the order the conditions are met, the
+    # condition is not rendered, its simplified text is only computed when it is printed
+    key = tuple(a.get_id() if z3.is_expr(a) else a for a in getattr(assertions, "assertions", assertions))
+    return condition_labels.setdefault(key, f"{CONDITION_EDGE_LABEL_PREFIX}{len(condition_labels)}")
+
+
+def get_edge_label_text(label, assertions):
+    # the label shown to users, conditions are rendered, and simplified, only here
+    prefix = UNKNOWN_EDGE_LABEL_PREFIX if is_unknown_edge_label(label) else ""
+    if not label.startswith(CONDITION_EDGE_LABEL_PREFIX, len(prefix)):
+        return label
+    return prefix + "z3" + str(assertions)
+
+
 def create_graph_from_system(system: System) -> UndirectedGraph:
 
     graph = UndirectedGraph()
 
+    # z3 variables are interned per analysis
+    clear_variables()
+
     # flatten remote transactions
-    changed = True
-    while changed:
-        changed = False
-        units = refresh_unit_and_add_labels(system)
-        for u1 in units:
-            if isinstance(u1, RemoteBusinessTransaction):
-                changed = True
-                units_to_copy = u1.business_transaction.business_transaction_units
-                unit_clones = list(map(lambda unit: copy.deepcopy(unit), units_to_copy))
-                system.get_bt_of_unit(u1).replace_remote_call(u1, unit_clones)
+    flatten_remote_calls(system)
 
     # internal business transactions are only used during remote flattening
     # these transactions are not visible to the public which internally means
@@ -51,6 +98,7 @@ def create_graph_from_system(system: System) -> UndirectedGraph:
     units = refresh_unit_and_add_labels(system)
 
     # expand write self loops to clone business transactions
+    clone_origins = dict()
     if PARALLEL_EXPANSION:
         bt_added_with_self_expansion = set()
         for unit in units:
@@ -63,8 +111,9 @@ def create_graph_from_system(system: System) -> UndirectedGraph:
 
                     units_to_copy = bt_of_unit.business_transaction_units
                     unit_clones = list(map(lambda unit: copy.deepcopy(unit), units_to_copy))
-                    for u in unit_clones:
+                    for u, original in zip(unit_clones, units_to_copy):
                         u.set_cloned(True)
+                        clone_origins[u] = original
 
                     microservice_owner_of_bt.add_bt(BusinessTransaction(bt_of_unit.name + "Parallel", unit_clones, bt_of_unit.params))
                     bt_added_with_self_expansion.add(bt_of_unit.name + "Parallel")
@@ -72,37 +121,49 @@ def create_graph_from_system(system: System) -> UndirectedGraph:
 
         units = refresh_unit_and_add_labels(system)
 
-    # add table dependencies
-    for u1, u2 in itertools.combinations(units, 2):
-        for o1, o2 in itertools.product(u1.operations, u2.operations):
+    # add table dependencies, only for pairs that can share a written column (or a business transaction)
+    footprint_index = build_footprint_index(units)
+    candidate_pairs = get_candidate_pairs(units, footprint_index)
+
+    # add edges considering operations conditions (using z3)
+    condition_labels = dict()
+    if OPERATION_PREDICATE:
+        for (u1, u2), (edge, assertions) in zip(candidate_pairs, check_edges_with_clones(candidate_pairs, clone_origins)):
+            if edge is not False and not graph.has_edge(u1, u2):
+                label = get_condition_label(assertions, condition_labels)
+                graph.add_edge(u1, u2, get_edge_label(edge, label), assertions)
+
+    else:
+        for u1, u2 in candidate_pairs:
+            for o1, o2 in itertools.product(u1.operations, u2.operations):
 
-            # add edge if same table, ignoring operation wheres
-            if not OPERATION_PREDICATE and o1.table.name == o2.table.name:
-                label = get_ops_edge_label(o1, o2)
+                # add edge if same table, ignoring operation wheres
+                if o1.table.name == o2.table.name:
+                    label = get_ops_edge_label(o1, o2)
 
-                if not graph.has_edge(u1, u2) and label:
-                    graph.add_edge(u1, u2, label)
+                    if not graph.has_edge(u1, u2) and label:
+                        graph.add_edge(u1, u2, label)
 
-            # add edges considering operations conditions (using z3)
-            else:
-                edge, assertions = check_edge(u1, u2)
+                else:
+                    edge, assertions = check_edge(u1, u2)
 
-                if edge and not graph.has_edge(u1, u2):
-                    graph.add_edge(u1, u2, "z3" + str(assertions), assertions)
+                    if edge is not False and not graph.has_edge(u1, u2):
+                        label = get_condition_label(assertions, condition_labels)
+                        graph.add_edge(u1, u2, get_edge_label(edge, label), assertions)
 
     # add edges between local transactions in each business transactions using variables
     if DATA_DEP:
+        sequence_pairs = []
         for m in system.microservices:
             for bt in m.business_transactions:
                 for i in range(len(bt.business_transaction_units) - 1):
                     for j in range(i + 1, len(bt.business_transaction_units)):
-                        lt_1 = bt.business_transaction_units[i]
-                        lt_2 = bt.business_transaction_units[j]
+                        sequence_pairs.append((bt.business_transaction_units[i], bt.business_transaction_units[j]))
 
-                        edge, assertions = check_edge(lt_1, lt_2)
-                        #TODO join labels
-                        if edge and not graph.has_edge(lt_1, lt_2):
-                            graph.add_edge(lt_1, lt_2, "output->input dependency", assertions)
+        for (lt_1, lt_2), (edge, assertions) in zip(sequence_pairs, check_edges_with_clones(sequence_pairs, clone_origins)):
+            #TODO join labels
+            if edge is not False and not graph.has_edge(lt_1, lt_2):
+                graph.add_edge(lt_1, lt_2, get_edge_label(edge, "output->input dependency"), assertions)
 
     # add edges between local transactions just because they are in sequence
     else:
@@ -125,6 +186,42 @@ def create_graph_from_system(system: System) -> UndirectedGraph:
     return graph
 
 
+def flatten_remote_calls(system):
+    # callees are flattened before their callers, so each business transaction is flattened only once
+    for bt in get_bts_in_call_order(system):
+        for unit in list(bt.business_transaction_units):
+            if isinstance(unit, RemoteBusinessTransaction):
+                callee_units = unit.business_transaction.business_transaction_units
+                bt.replace_remote_call(unit, [u.clone() for u in callee_units])
+
+
+def get_bts_in_call_order(system):
+    # post order of the remote call graph, callees first
+    ordered = []
+    visited = set()
+
+    def visit(bt, calling):
+        if bt in calling:
+            raise ValueError(f"Recursive remote call to business transaction {bt.name}")
+        if bt in visited:
+            return
+
+        calling.append(bt)
+        for unit in bt.business_transaction_units:
+            if isinstance(unit, RemoteBusinessTransaction):
+                visit(unit.business_transaction, calling)
+        calling.pop()
+
+        visited.add(bt)
+        ordered.append(bt)
+
+    for m in system.microservices:
+        for bt in m.business_transactions:
+            visit(bt, [])
+
+    return ordered
+
+
 def refresh_unit_and_add_labels(system):
     units = [bu for m in system.microservices for bt in m.business_transactions for bu in bt.business_transaction_units]
     label_counter = 1
@@ -132,3 +229,200 @@ def refresh_unit_and_add_labels(system):
         u.set_label(str(label_counter))
         label_counter += 1
     return units
+
+
+def build_footprint_index(units):
+    # (table, column, operation type) -> units with an operation touching that column
+    index = dict()
+    for u in units:
+        for o in u.operations:
+            for c in o.used_columns:
+                index.setdefault((o.table.name, c, o.type), set()).add(u)
+    return index
+
+
+def get_candidate_pairs(units, footprint_index):
+    # check_edge can only find an edge between two units if they share a column and one of them writes it,
+    # or if both belong to the same business transaction (variable dependencies)
+    position = {u: i for i, u in enumerate(units)}
+    candidates = set()
+
+    def add_pairs(group_1, group_2):
+        for u1 in group_1:
+            for u2 in group_2:
+                if u1 is not u2:
+                    i, j = sorted((position[u1], position[u2]))
+                    candidates.add((i, j))
+
+    tables = dict()
+    for (table, column, op_type), touching_units in footprint_index.items():
+        if op_type != OperationType.WRITE:
+            continue
+        add_pairs(touching_units, touching_units)
+        add_pairs(touching_units, footprint_index.get((table, column, OperationType.READ), set()))
+        tables.setdefault(table, set()).update(touching_units)
+
+    # without predicates any access to the same table is a conflict, whatever the columns
+    if not OPERATION_PREDICATE:
+        for (table, column, op_type), touching_units in footprint_index.items():
+            add_pairs(tables.get(table, set()), touching_units)
+
+    by_bt = dict()
+    for u in units:
+        by_bt.setdefault(u.bt_owner, []).append(u)
+    for bt_units in by_bt.values():
+        add_pairs(bt_units, bt_units)
+
+    return [(units[i], units[j]) for i, j in sorted(candidates)]
+
+
+def check_edges_with_clones(pairs, clone_origins):
+    # pairs of cloned units get the result of the equivalent pair of original units, with the z3 variables
+    # of the cloned side renamed, instead of being solved again
+    if not DERIVE_CLONE_EDGES or not clone_origins:
+        return check_edges(pairs)
+
+    origin_pairs = [get_origin_pair(u1, u2, clone_origins) for u1, u2 in pairs]
+
+    to_solve = dict()
+    for pair, origin_pair in zip(pairs, origin_pairs):
+        to_solve[origin_pair or pair] = None
+    for pair, result in zip(to_solve, check_edges(list(to_solve))):
+        to_solve[pair] = result
+
+    results = []
+    not_derived = []
+    renamings = dict()
+    for pair, origin_pair in zip(pairs, origin_pairs):
+        if not origin_pair:
+            results.append(to_solve[pair])
+            continue
+
+        # renamed unsimplified, the derived condition is simplified when it is read like the others
+        edge, assertions = to_solve[origin_pair]
+        raw_assertions = getattr(assertions, "assertions", assertions)
+        renaming = get_pair_renaming(pair, raw_assertions, clone_origins, renamings)
+        if renaming is None:
+            not_derived.append(len(results))
+            results.append(None)
+        elif renaming:
+            results.append((edge, Condition([z3.substitute(a, *renaming) for a in raw_assertions])))
+        else:
+            results.append((edge, assertions))
+
+    # clones that share variables with the other side in a way a renaming can not express
+    for i, result in zip(not_derived, check_edges([pairs[i] for i in not_derived])):
+        results[i] = result
+
+    return results
+
+
+def get_origin_pair(u1, u2, clone_origins):
+    o1 = clone_origins.get(u1, u1)
+    o2 = clone_origins.get(u2, u2)
+    if (o1, o2) == (u1, u2) or o1 is o2:
+        return None
+
+    # variable dependencies are only considered inside a business transaction, the pairs must agree on it
+    if (o1.bt_owner == o2.bt_owner) != (u1.bt_owner == u2.bt_owner):
+        return None
+
+    return o1, o2
+
+
+def get_pair_renaming(pair, assertions, clone_origins, renamings):
+    # (original variable, cloned variable) pairs, or None if renaming would merge or split variables
+    sides = []
+    for u in pair:
+        if u in clone_origins and u not in renamings:
+            renamings[u] = get_unit_renaming(u, clone_origins)
+        sides.append(renamings.get(u, dict()))
+
+    # z3 expressions are keyed by ast id, == on them builds a formula instead of comparing
+    renaming = []
+    images = set()
+    for v in get_free_constants(assertions):
+        side_images = {side[v.get_id()].get_id(): side[v.get_id()] for side in sides if v.get_id() in side}
+        if len(side_images) > 1:
+            return None
+        image = side_images.popitem()[1] if side_images else v
+        if image.get_id() in images:
+            return None
+        images.add(image.get_id())
+        if not v.eq(image):
+            renaming.append((v, image))
+
+    return renaming
+
+
+def get_unit_renaming(clone, clone_origins):
+    # variables of the clone's operations and of the past operations feeding its inputs
+    renaming = dict()
+    bt_units = clone.bt_owner.business_transaction_units
+    for unit in bt_units[:bt_units.index(clone) + 1]:
+        for clone_op, op in zip(unit.operations, clone_origins[unit].operations):
+            # an operation without a valid context never reaches the solver, so it has nothing to rename
+            try:
+                clone_ctx = clone_op.get_operation_ctx()
+                ctx = op.get_operation_ctx()
+            except ValueError:
+                continue
+            for key, var in ctx.items():
+                renaming[var.get_id()] = clone_ctx[key]
+    return renaming
+
+
+# pairs being checked by the worker pool, inherited by the forked workers
+_pairs_to_check = []
+
+
+def check_edges(pairs):
+    # results are returned in the same order as the pairs, whatever the number of workers
+    if not EDGE_CACHE_PATH:
+        return solve_edges(pairs)
+
+    with EdgeCache(EDGE_CACHE_PATH) as cache:
+        suffixes = [get_label_suffixes(u1, u2) for u1, u2 in pairs]
+        fingerprints = [get_edge_fingerprint(u1, u2, s) for (u1, u2), s in zip(pairs, suffixes)]
+        results = [cache.get(f, s) if f else None for f, s in zip(fingerprints, suffixes)]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        for i, result in zip(missing, solve_edges([pairs[i] for i in missing])):
+            results[i] = result
+            # unknown verdicts are not stored, they may be decided with more time
+            if fingerprints[i] and result[0] is not None:
+                cache.put(fingerprints[i], *result, suffixes[i])
+
+    return results
+
+
+def solve_edges(pairs):
+    if not pairs:
+        return []
+
+    if EDGE_CHECK_WORKERS <= 1 or len(pairs) < 2 or "fork" not in multiprocessing.get_all_start_methods():
+        return solve_edges_in_process(pairs)
+
+    global _pairs_to_check
+    _pairs_to_check = pairs
+    try:
+        # forked workers get their own copy of the system and of the z3 context
+        with multiprocessing.get_context("fork").Pool(EDGE_CHECK_WORKERS) as pool:
+            chunk_size = max(1, len(pairs) // (EDGE_CHECK_WORKERS * 4))
+            chunks = [range(i, min(i + chunk_size, len(pairs))) for i in range(0, len(pairs), chunk_size)]
+            results = [result for chunk in pool.map(_check_edges_in_worker, chunks) for result in chunk]
+    finally:
+        _pairs_to_check = []
+
+    return [(edge, Condition(deserialize_assertions(smt2))) for edge, smt2 in results]
+
+
+def solve_edges_in_process(pairs):
+    if EDGE_CHECK_BATCH_SIZE > 0:
+        return check_edges_batch(pairs, EDGE_CHECK_BATCH_SIZE)
+    return [check_edge(u1, u2) for u1, u2 in pairs]
+
+
+def _check_edges_in_worker(indices):
+    results = solve_edges_in_process([_pairs_to_check[i] for i in indices])
+    return [(edge, serialize_assertions(assertions)) for edge, assertions in results]
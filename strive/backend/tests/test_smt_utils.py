@@ -2,8 +2,12 @@ from unittest import TestCase
 
 from core.system_processor import get_cycles_and_dag_paths, verify_cycles
 from domain.domain_model import *
-from parser.smt_utils import check_edge
+from domain.graphUtils import UndirectedGraph
+from parser.predicate_analyzer import decide_conjunction
+from parser.smt_utils import check_edge, serialize_assertions, deserialize_assertions, check_cycle_sat, \
+    cycle_sat_cache, check_edges_batch
 from parser.system_parser import create_graph_from_system
+from resources.system_examples import example_4
 
 
 class Test(TestCase):
@@ -326,4 +330,96 @@ class Test(TestCase):
 
 
         edge, assertions = check_edge(local_transaction_1, local_transaction_2)
-        print(edge, assertions)
\ No newline at end of file
+        print(edge, assertions)
+
+    def test_serialized_assertions_round_trip(self):
+        user_t = Table("user", [Column("id", str), Column("age", int), Column("admin", bool)])
+
+        assertions = [z3.And(user_t.column("id") == z3.StringVal("a b"), user_t.column("age") > 18),
+                      z3.Not(user_t.column("admin")),
+                      z3.BoolVal(True)]
+
+        restored = deserialize_assertions(serialize_assertions(assertions))
+
+        self.assertEqual(len(assertions), len(restored))
+        for a, r in zip(assertions, restored):
+            self.assertTrue(a.eq(r))
+
+    def test_variables_and_predicates_are_built_once(self):
+        user_t = Table("user", [Column("id", int), Column("admin", bool)])
+        self.assertIs(user_t.column("id"), user_t.column("id"))
+
+        calls = []
+        read_wheres = lambda ctx: calls.append(ctx) or user_t.column("id") == ctx["x"]
+        read_user = Operation("readUser", [InputParameter("x", int)], OperationType.READ, user_t, read_wheres)
+        local_transaction = LocalTransaction([read_user], [InputParameter("x", int)])
+        BusinessTransaction("BT", [local_transaction], [InputParameter("x", int)])
+        local_transaction.label = "1"
+
+        predicate = read_user.get_predicate_assertion()
+        self.assertIs(predicate, read_user.get_predicate_assertion())
+        self.assertEqual(1, len(calls))
+        self.assertIs(get_variable("x_BT", int), read_user.get_operation_ctx()["x"])
+
+    def test_cycle_sat_is_cached_by_assertion_set(self):
+        x = z3.Int("x")
+        a, b, c = [SavedTransaction(label, label, False) for label in ["1", "2", "3"]]
+        graph = UndirectedGraph()
+        graph.add_edge(a, b, "z3", [x > 1])
+        graph.add_edge(b, c, "z3", [x < 3])
+        graph.add_edge(a, c, "z3", [x > 1, x < 3])
+
+        cycle_sat_cache.clear()
+        result, assertions = check_cycle_sat([a, b, c], graph)
+        self.assertTrue(result)
+        self.assertEqual((0, 1), (cycle_sat_cache.hits, cycle_sat_cache.misses))
+
+        # another ordering with the same assertions
+        self.assertEqual((result, assertions), check_cycle_sat([b, a, c], graph))
+        self.assertEqual((1, 1), (cycle_sat_cache.hits, cycle_sat_cache.misses))
+
+    def test_predicate_analyzer_decides_equalities(self):
+        user_t = Table("user", [Column("id", int), Column("name", str), Column("admin", bool)])
+        x, y = z3.Ints("x y")
+
+        self.assertEqual(z3.sat, decide_conjunction([z3.And(user_t.column("id") == x, x == y)]))
+        self.assertEqual(z3.unsat, decide_conjunction([user_t.column("id") == x, x == y, z3.Not(user_t.column("id") == y)]))
+        self.assertEqual(z3.unsat, decide_conjunction([user_t.column("name") == z3.StringVal("a"),
+                                                       user_t.column("name") == z3.StringVal("b")]))
+        self.assertEqual(z3.unsat, decide_conjunction([user_t.column("admin"), z3.Not(user_t.column("admin"))]))
+
+        # left to z3
+        self.assertIsNone(decide_conjunction([user_t.column("id") > x]))
+        self.assertIsNone(decide_conjunction([z3.Or(x == 1, y == 1)]))
+        self.assertIsNone(decide_conjunction([user_t.column("admin") != z3.Bool("other")]))
+
+    def test_cycle_witness_is_computed_on_demand(self):
+        x = z3.Int("x")
+        a, b, c = [SavedTransaction(label, label, False) for label in ["1", "2", "3"]]
+        graph = UndirectedGraph()
+        graph.add_edge(a, b, "z3", [x > 1])
+        graph.add_edge(b, c, "z3", [x < 3])
+        graph.add_edge(a, c, "z3", [x != 5])
+
+        cycle_sat_cache.clear()
+        result, condition = check_cycle_sat([a, b, c], graph)
+        self.assertTrue(result)
+        self.assertIsNone(condition.simplified)
+
+        self.assertEqual(2, condition.witness().eval(x).as_long())
+        self.assertIsNone(condition.simplified)
+        self.assertIn("x", str(condition))
+        self.assertIsNotNone(condition.simplified)
+
+    def test_batched_edge_checks_match_single_checks(self):
+        system = example_4()
+        units = [u for m in system.microservices for bt in m.business_transactions
+                 for u in bt.business_transaction_units if isinstance(u, LocalTransaction)]
+        pairs = [(u1, u2) for i, u1 in enumerate(units) for u2 in units[i + 1:]]
+
+        def results(checks):
+            return [(edge, str(assertions)) for edge, assertions in checks]
+
+        single = results(check_edge(u1, u2) for u1, u2 in pairs)
+        self.assertEqual(single, results(check_edges_batch(pairs, 3)))
+        self.assertIn(True, [edge for edge, _ in single])
@@ -1,6 +1,10 @@
+import copy
+import os
+import tempfile
 import unittest
-from unittest import TestCase
+from unittest import TestCase, mock
 
+from parser.smt_utils import get_edge_assertions
 from parser.system_parser import *
 from resources.system_examples import *
 
@@ -159,4 +163,247 @@ class Test(TestCase):
 
         self.assertEqual(sorted(solution.business_sequences()),
                          sorted([[n.label for n in business_sequence]
-                                 for business_sequence in graph.business_sequences()]))
\ No newline at end of file
+                                 for business_sequence in graph.business_sequences()]))
+
+class TestGraphConstruction(TestCase):
+
+    def test_candidate_pairs_share_written_column_or_bt(self):
+        system = example_9()
+        units = refresh_unit_and_add_labels(system)
+
+        footprint_index = build_footprint_index(units)
+        pairs = get_candidate_pairs(units, footprint_index)
+
+        # 1 reads a, 2 reads b (same bt), 3 and 4 write a
+        self.assertEqual([("1", "2"), ("1", "3"), ("1", "4"), ("3", "4")],
+                         [(u1.label, u2.label) for u1, u2 in pairs])
+
+    def test_candidate_pairs_ignore_disjoint_columns(self):
+        user_t = Table("user", [Column("id", str), Column("age", int), Column("admin", bool)])
+
+        read = Operation("read", [], OperationType.READ, user_t, [], ["age"])
+        write = Operation("write", [], OperationType.WRITE, user_t, [], ["admin"])
+
+        bt_1 = BusinessTransaction("BT1", [LocalTransaction([read])])
+        bt_2 = BusinessTransaction("BT2", [LocalTransaction([write])])
+        system = System([Microservice("MS", [bt_1, bt_2])])
+        units = refresh_unit_and_add_labels(system)
+
+        self.assertEqual([], get_candidate_pairs(units, build_footprint_index(units)))
+
+    def test_parallel_edge_checks_match_sequential(self):
+        sequential_graph = create_graph_from_system(example_4())
+
+        set_edge_check_workers(2)
+        try:
+            parallel_graph = create_graph_from_system(example_4())
+        finally:
+            set_edge_check_workers(1)
+
+        def edges(graph):
+            return sorted((n1.label, n2.label, str(label))
+                          for n1 in graph.nodes() for n2, label in graph.get_neighbours(n1))
+
+        self.assertEqual(edges(sequential_graph), edges(parallel_graph))
+
+    def test_edge_cache_skips_solver_on_second_build(self):
+        def edges(graph):
+            return sorted((n1.label, n2.label, str(label))
+                          for n1 in graph.nodes() for n2, label in graph.get_neighbours(n1))
+
+        with tempfile.TemporaryDirectory() as directory:
+            set_edge_cache_path(os.path.join(directory, "edges.sqlite"))
+            try:
+                first_graph = create_graph_from_system(example_1())
+
+                with mock.patch("parser.system_parser.check_edge", side_effect=AssertionError("cache miss")), \
+                        mock.patch("parser.system_parser.check_edges_batch", side_effect=AssertionError("cache miss")):
+                    second_graph = create_graph_from_system(example_1())
+            finally:
+                set_edge_cache_path(None)
+
+        self.assertEqual(edges(first_graph), edges(second_graph))
+
+    def test_same_table_edges_without_operation_predicates(self):
+        def edges(graph):
+            return {(n1.label, n2.label, label if label in ("READ", "WRITE") else label[:2])
+                    for n1 in graph.nodes() for n2, label in graph.get_neighbours(n1) if n1.label < n2.label}
+
+        with mock.patch("parser.system_parser.OPERATION_PREDICATE", False):
+            graph_1 = create_graph_from_system(example_1())
+            graph_4 = create_graph_from_system(example_4())
+            graph_9 = create_graph_from_system(example_9())
+
+        self.assertEqual(21, len(edges(graph_1)))
+        self.assertEqual({("10", "11", "z3"), ("7", "8", "z3")}, {e for e in edges(graph_4) if e[2] == "z3"})
+        self.assertEqual({("1", "3", "READ"), ("1", "4", "READ"), ("1", "5", "READ"), ("1", "6", "READ"),
+                          ("3", "4", "WRITE"), ("3", "5", "WRITE"), ("3", "6", "WRITE"), ("4", "5", "WRITE"),
+                          ("4", "6", "WRITE"), ("5", "6", "WRITE")}, edges(graph_9))
+
+    def test_edge_cache_hits_survive_label_renumbering(self):
+        def birthday_system(extra_bt, increment):
+            user_t = Table("user", [Column("id", int), Column("age", int)])
+            read_age = Operation("readAge", [InputParameter("x", int), OutputParameter("age", int)],
+                                 OperationType.READ, user_t, lambda ctx: user_t.column("id") == ctx["x"])
+            update_age = Operation("updateAge", [InputParameter("x", int), InputParameter("age", int)],
+                                   OperationType.WRITE, user_t,
+                                   lambda ctx: z3.And(user_t.column("id") == ctx["x"],
+                                                      user_t.column("age") == ctx["age"] + increment))
+            lt_1 = LocalTransaction([read_age], [InputParameter("x", int), OutputParameter("age", int)])
+            lt_2 = LocalTransaction([update_age], [InputParameter("x", int), InputParameter("age", int)])
+            bts = [BusinessTransaction("birthday", [lt_1, lt_2], [InputParameter("x", int)])]
+            if extra_bt:
+                other_t = Table("other", [Column("id", int)])
+                other_op = Operation("readOther", [], OperationType.READ, other_t)
+                bts.insert(0, BusinessTransaction("other", [LocalTransaction([other_op])]))
+            return System([Microservice("MS", bts)])
+
+        def edges(graph):
+            return sorted((n1.label, n2.label, str(graph.get_assertions_of_nodes(n1, n2)))
+                          for n1 in graph.nodes() for n2, _ in graph.get_neighbours(n1))
+
+        expected = edges(create_graph_from_system(birthday_system(True, 1)))
+        with tempfile.TemporaryDirectory() as directory:
+            set_edge_cache_path(os.path.join(directory, "edges.sqlite"))
+            try:
+                create_graph_from_system(birthday_system(False, 1))
+
+                # a business transaction added first renumbers the labels, variables named after them included
+                with mock.patch("parser.system_parser.solve_edges", wraps=solve_edges) as solved:
+                    graph = create_graph_from_system(birthday_system(True, 1))
+                self.assertEqual([], [pair for call in solved.call_args_list for pair in call.args[0]])
+                self.assertEqual(expected, edges(graph))
+
+                # a changed predicate is solved again
+                with mock.patch("parser.system_parser.solve_edges", wraps=solve_edges) as solved:
+                    create_graph_from_system(birthday_system(True, 2))
+                self.assertTrue([pair for call in solved.call_args_list for pair in call.args[0]])
+            finally:
+                set_edge_cache_path(None)
+
+    def test_edge_conditions_are_not_simplified_while_building(self):
+        with mock.patch("parser.smt_utils.simplify", side_effect=AssertionError("simplified")):
+            graph = create_graph_from_system(example_12())
+
+        node = next(n for n in graph.nodes() if graph.get_neighbours(n))
+        neighbour, label = graph.get_neighbours(node)[0]
+        self.assertTrue(label.startswith("z3 condition"))
+        self.assertNotIn("simplified", str(graph.get_assertions_of_nodes(node, neighbour)))
+
+    def test_clone_edges_are_derived_from_original_pairs(self):
+        def edges(graph):
+            return sorted((n1.label, n2.label) for n1 in graph.nodes() for n2, _ in graph.get_neighbours(n1))
+
+        # the assertions of every pair that is solved, whether alone or in a batch
+        with mock.patch("parser.smt_utils.get_edge_assertions", side_effect=get_edge_assertions) as solved:
+            derived_graph = create_graph_from_system(example_3())
+            derived_calls = solved.call_count
+
+        with mock.patch("parser.system_parser.DERIVE_CLONE_EDGES", False), \
+                mock.patch("parser.smt_utils.get_edge_assertions", side_effect=get_edge_assertions) as solved:
+            solved_graph = create_graph_from_system(example_3())
+            solved_calls = solved.call_count
+
+        self.assertEqual(edges(solved_graph), edges(derived_graph))
+        self.assertLess(derived_calls, solved_calls)
+
+    def test_flatten_remote_calls_clones_callee_units(self):
+        system = example_1()
+        withdraw_bt = system.microservices[0].business_transactions[1]
+        get_score_bt = system.microservices[1].business_transactions[0]
+
+        flatten_remote_calls(system)
+
+        self.assertEqual(3, len(withdraw_bt.business_transaction_units))
+        self.assertFalse(any(isinstance(u, RemoteBusinessTransaction) for u in withdraw_bt.business_transaction_units))
+
+        clone = withdraw_bt.business_transaction_units[0]
+        original = get_score_bt.business_transaction_units[0]
+        self.assertIsNot(original, clone)
+        self.assertIs(withdraw_bt, clone.bt_owner)
+        self.assertIs(clone, clone.operations[0].lt_owner)
+        self.assertIs(original.operations[0].table, clone.operations[0].table)
+
+    def test_recursive_remote_calls_are_rejected(self):
+        a_t = Table("aTable", [Column("id", str)])
+        read_a_op = Operation("readAOperation", [], OperationType.READ, a_t)
+
+        bt_1 = BusinessTransaction("BT1", [LocalTransaction([read_a_op])])
+        bt_2 = BusinessTransaction("BT2", [RemoteBusinessTransaction(bt_1)])
+        bt_1.business_transaction_units.append(RemoteBusinessTransaction(bt_2))
+
+        system = System([Microservice("MS", [bt_1, bt_2])])
+
+        with self.assertRaises(ValueError):
+            create_graph_from_system(system)
+
+    def test_system_lookups_follow_added_and_replaced_units(self):
+        a_t = Table("aTable", [Column("id", str)])
+        lt_1 = LocalTransaction([Operation("readAOperation", [], OperationType.READ, a_t)])
+        lt_2 = LocalTransaction([Operation("writeAOperation", [], OperationType.WRITE, a_t)])
+        remote = RemoteBusinessTransaction(None)
+
+        bt_1 = BusinessTransaction("BT1", [lt_1, remote])
+        m = Microservice("MS", [bt_1])
+        system = System([m])
+        self.assertEqual(system.get_bt_of_unit(lt_1), bt_1)
+        self.assertEqual(system.get_m_of_bt(bt_1), m)
+
+        bt_1.replace_remote_call(remote, [lt_2])
+        self.assertEqual(system.get_bt_of_unit(lt_2), bt_1)
+        self.assertIsNone(system.get_bt_of_unit(remote))
+
+        bt_2 = copy.deepcopy(bt_1)
+        m.add_bt(bt_2)
+        self.assertEqual(system.get_m_of_bt(bt_2), m)
+        bt_2.business_transaction_units[0].label = "copied"
+        self.assertEqual(system.get_bt_of_unit_label("copied"), bt_2)
+
+        m.remove_bt(bt_2)
+        self.assertIsNone(system.get_m_of_bt(bt_2))
+        self.assertIsNone(system.get_bt_of_unit_label("copied"))
+
+    def test_system_lookups_find_units_and_bts_added_directly(self):
+        a_t = Table("aTable", [Column("id", str)])
+        lt_1 = LocalTransaction([Operation("readAOperation", [], OperationType.READ, a_t)])
+        lt_2 = LocalTransaction([Operation("writeAOperation", [], OperationType.WRITE, a_t)])
+        lt_3 = LocalTransaction([Operation("writeAOperation", [], OperationType.WRITE, a_t)])
+
+        bt_1 = BusinessTransaction("BT1", [lt_1])
+        m = Microservice("MS", [bt_1])
+        system = System([m])
+        lt_1.label = "first"
+        self.assertEqual(system.get_bt_of_unit_label("first"), bt_1)
+
+        bt_1.business_transaction_units.append(lt_2)
+        lt_2.label = "appended"
+        self.assertEqual(system.get_bt_of_unit_label("appended"), bt_1)
+
+        bt_2 = BusinessTransaction("BT2", [lt_3])
+        m.business_transactions.append(bt_2)
+        lt_3.label = "appended_bt"
+        self.assertEqual(system.get_m_of_bt(bt_2), m)
+        self.assertEqual(system.get_bt_of_unit_label("appended_bt"), bt_2)
+        self.assertIsNone(system.get_bt_of_unit_label("missing"))
+
+    def test_graph_adjacency_and_sequence_lookups(self):
+        graph = create_graph_from_system(example_9())
+        sequence = graph.business_sequences()[0]
+        node = sequence[0]
+        neighbour, label = graph.get_neighbours(node)[0]
+
+        self.assertIs(graph.get_business_sequence_of(node), sequence)
+        self.assertTrue(graph.has_edge(neighbour, node))
+        self.assertIn((node, label), list(graph.iter_neighbours(neighbour)))
+
+        graph.remove_edge(node, neighbour)
+        self.assertFalse(graph.has_edge(node, neighbour))
+        self.assertFalse(graph.has_edge(neighbour, node))
+
+    def test_unknown_edges_are_kept_and_tagged(self):
+        with mock.patch("parser.smt_utils.get_edge_verdict", return_value=None):
+            graph = create_graph_from_system(example_9())
+
+        labels = [label for n in graph.nodes() for _, label in graph.iter_neighbours(n)]
+        self.assertTrue(labels)
+        self.assertTrue(all(is_unknown_edge_label(label) for label in labels))
@@ -1,13 +1,30 @@
+import os
+import tempfile
 from inspect import getmembers, isfunction
-from unittest import TestCase
+from unittest import TestCase, mock
 
-from core.system_processor import get_cycles_and_dag_paths, set_self_loop_budget, verify_cycles
+import core.system_processor
+from core.system_processor import get_cycles_and_dag_paths, set_self_loop_budget, verify_cycles, dfs_cycles, \
+    generate_dependency_dag, get_valid_starting_nodes, set_incremental_cycle_sat, set_unsat_core_pruning, \
+    get_cycles_and_dag_paths_with_status, set_cycle_search_workers, extend_future_order, set_canonical_clone_cycles, \
+    iter_cycles_and_dag_paths, set_max_cycle_length, set_iterative_deepening, iter_cycles, AnalysisStatus
+from domain.graphUtils import UndirectedGraph
+from parser.graph_file import save_graph, load_graph
 from parser.system_parser import create_graph_from_system
 from resources import system_examples
 from resources.system_examples import *
 
 
 class Test(TestCase):
+    def setUp(self):
+        # the search settings the tests change are restored after each test, even when it fails
+        for name in ["SELF_LOOP_BUDGET", "INCREMENTAL_CYCLE_SAT", "UNSAT_CORE_PRUNING", "CYCLE_SEARCH_WORKERS",
+                     "CANONICAL_CLONE_CYCLES", "VISIT_FUTURE_ONLY", "MAX_CYCLE_LENGTH", "ITERATIVE_DEEPENING",
+                     "ANALYSIS_TIME_BUDGET_S"]:
+            patcher = mock.patch.object(core.system_processor, name, getattr(core.system_processor, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     def test_run_all_without_exceptions(self):
 
         example_functions = getmembers(system_examples, isfunction)
@@ -56,3 +73,233 @@ class Test(TestCase):
         cycles, paths, topological_paths_for_cycles = get_cycles_and_dag_paths(graph)
         for c in cycles:
             self.assertTrue(len(cycles) <= 4)
+
+    def test_frozen_graph_matches_graph(self):
+        system = example_10()
+        graph = create_graph_from_system(system)
+        set_self_loop_budget(0)
+        frozen = graph.freeze()
+        self.assertIs(frozen, graph.freeze())
+
+        cycles, used_edges, _ = dfs_cycles(frozen, get_valid_starting_nodes(graph))
+        self.assertTrue(cycles)
+        for cycle in cycles:
+            dag = generate_dependency_dag(graph, cycle)
+            frozen_dag = generate_dependency_dag(frozen, [frozen.index[n] for n in cycle])
+            self.assertEqual(set(dag.edges), set(frozen_dag.edges))
+            self.assertEqual("start", used_edges[cycle][0][1])
+
+        graph.remove_edge(*cycle[:2])
+        self.assertIsNot(frozen, graph.freeze())
+
+    def test_saved_graph_gives_the_same_paths(self):
+        graph = create_graph_from_system(example_10())
+        set_self_loop_budget(0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            save_graph(graph, os.path.join(tmp, "graph.json"))
+            loaded = load_graph(os.path.join(tmp, "graph.json"))
+
+        cycles, paths, _, _ = get_cycles_and_dag_paths(graph)
+        loaded_cycles, loaded_paths, _, _ = get_cycles_and_dag_paths(loaded)
+
+        self.assertEqual(paths, loaded_paths)
+        self.assertEqual(sorted(tuple(n.label for n in c) for c in cycles),
+                         sorted(tuple(n.label for n in c) for c in loaded_cycles))
+        self.assertEqual(sorted(str(c) for c in cycles), sorted(str(c) for c in loaded_cycles))
+
+    def test_incremental_cycle_sat_finds_the_same_cycles(self):
+        set_self_loop_budget(1)
+        for example in [example_10, example_12]:
+            graph = create_graph_from_system(example())
+            cycles, used_edges, assertions = dfs_cycles(graph, get_valid_starting_nodes(graph))
+
+            set_incremental_cycle_sat(True)
+            try:
+                incremental_cycles, incremental_used_edges, incremental_assertions = \
+                    dfs_cycles(graph, get_valid_starting_nodes(graph))
+            finally:
+                set_incremental_cycle_sat(False)
+
+            self.assertEqual(cycles, incremental_cycles)
+            self.assertEqual(used_edges, incremental_used_edges)
+            self.assertEqual({c: sorted(map(str, a)) for c, a in assertions.items()},
+                             {c: sorted(map(str, a)) for c, a in incremental_assertions.items()})
+        set_self_loop_budget(0)
+
+    def test_parallel_cycle_search_matches_sequential(self):
+        set_self_loop_budget(1)
+        for example in [example_10, example_12]:
+            graph = create_graph_from_system(example())
+            cycles, used_edges, assertions = dfs_cycles(graph, get_valid_starting_nodes(graph))
+
+            set_cycle_search_workers(2)
+            try:
+                parallel_cycles, parallel_used_edges, parallel_assertions = \
+                    dfs_cycles(graph, get_valid_starting_nodes(graph))
+            finally:
+                set_cycle_search_workers(1)
+
+            self.assertTrue(cycles)
+            self.assertEqual(cycles, parallel_cycles)
+            self.assertEqual(used_edges, parallel_used_edges)
+            self.assertEqual({c: sorted(map(str, a)) for c, a in assertions.items()},
+                             {c: sorted(map(str, a)) for c, a in parallel_assertions.items()})
+        set_self_loop_budget(0)
+
+    def test_unsat_cores_prune_later_paths(self):
+        x = z3.Int("x")
+        a_1, a_2, b, c, d = [SavedTransaction(label, label, False) for label in ["1", "2", "3", "4", "5"]]
+        BusinessTransaction("BT1", [a_1, a_2])
+        for n in [b, c, d]:
+            BusinessTransaction("BT" + n.label, [n])
+
+        graph = UndirectedGraph()
+        graph.add_edge(a_1, b, "z3", [x > 5])
+        for n in [c, d]:
+            graph.add_edge(b, n, "z3", [x > 0])
+            graph.add_edge(n, a_2, "z3", [x < 3])
+        graph.add_edge(c, d, "z3", [x > 0])
+        for s in [a_1.bt_owner, b.bt_owner, c.bt_owner, d.bt_owner]:
+            graph.add_business_sequence(s.business_transaction_units)
+
+        calls = []
+        for pruning in [False, True]:
+            set_unsat_core_pruning(pruning)
+            with mock.patch.object(core.system_processor, "check_cycle_sat",
+                                   wraps=core.system_processor.check_cycle_sat) as check_cycle_sat:
+                cycles, _, _ = dfs_cycles(graph, {a_1})
+            self.assertEqual(set(), cycles)
+            calls.append(check_cycle_sat.call_count)
+
+        self.assertEqual([4, 1], calls)
+
+    def test_unknown_cycles_are_kept_and_tagged(self):
+        graph = create_graph_from_system(example_10())
+        set_self_loop_budget(0)
+
+        with mock.patch.object(core.system_processor, "check_cycle_sat", return_value=(None, [])):
+            cycles, _, _, _, status = get_cycles_and_dag_paths_with_status(graph)
+
+        self.assertTrue(cycles)
+        self.assertEqual(cycles, status.unknown_cycles)
+        self.assertTrue(status.complete)
+
+    def test_time_budget_returns_partial_results(self):
+        graph = create_graph_from_system(example_10())
+        set_self_loop_budget(0)
+
+        cycles, paths, _, _, status = get_cycles_and_dag_paths_with_status(graph, time_budget=0)
+
+        self.assertFalse(status.complete)
+        self.assertEqual(set(), paths)
+
+    def test_cycle_search_skips_bridges(self):
+        a_1, a_2, b, c, d = [SavedTransaction(label, label, False) for label in ["1", "2", "3", "4", "5"]]
+        BusinessTransaction("BT1", [a_1, a_2])
+        for n in [b, c, d]:
+            BusinessTransaction("BT" + n.label, [n])
+
+        # a_1 - b - a_2 closes a cycle through BT1, c and d hang off it by bridges
+        graph = UndirectedGraph()
+        graph.add_edge(a_1, b, "z3", [True])
+        graph.add_edge(b, a_2, "z3", [True])
+        graph.add_edge(b, c, "z3", [True])
+        graph.add_edge(c, d, "z3", [True])
+        for s in [a_1.bt_owner, b.bt_owner, c.bt_owner, d.bt_owner]:
+            graph.add_business_sequence(s.business_transaction_units)
+
+        frozen = graph.freeze()
+        component, on_cycle = frozen.get_cycle_components()
+        self.assertEqual([-1, -1], [component[frozen.index[n]] for n in [c, d]])
+        self.assertEqual(1, len({component[frozen.index[n]] for n in [a_1, a_2, b]}))
+        self.assertEqual(4, sum(on_cycle))
+
+        cycles, _, _ = dfs_cycles(graph, {a_1, c})
+        self.assertEqual({(a_1, b, a_2)}, cycles)
+
+    def test_future_order_is_extended_one_node_at_a_time(self):
+        orders = extend_future_order({}, "BT1", 1)
+        orders = extend_future_order(orders, "BT2", 5)
+        self.assertEqual({"BT1": 1, "BT2": 5}, orders)
+        self.assertIs(orders, extend_future_order(orders, "BT1", 1))
+        self.assertEqual({"BT1": 2, "BT2": 5}, extend_future_order(orders, "BT1", 2))
+        self.assertIsNone(extend_future_order(orders, "BT2", 4))
+        self.assertEqual({"BT1": 1, "BT2": 5}, orders)
+
+    def test_mirror_cycles_through_clones_are_not_searched(self):
+        set_self_loop_budget(1)
+        graph = create_graph_from_system(example_10())
+
+        set_canonical_clone_cycles(False)
+        try:
+            all_cycles, _, _ = dfs_cycles(graph, get_valid_starting_nodes(graph))
+        finally:
+            set_canonical_clone_cycles(True)
+        cycles, _, _ = dfs_cycles(graph, get_valid_starting_nodes(graph))
+        set_self_loop_budget(0)
+
+        self.assertLess(len(cycles), len(all_cycles))
+        self.assertLessEqual(cycles, all_cycles)
+        # only cycles through a Parallel clone are left to their mirror image through the original
+        self.assertTrue(all(any(n.cloned for n in cycle) for cycle in all_cycles - cycles))
+
+    def test_cycles_and_paths_are_streamed(self):
+        graph = create_graph_from_system(example_10())
+        set_self_loop_budget(0)
+        cycles, paths, _, _ = get_cycles_and_dag_paths(graph)
+
+        results = iter_cycles_and_dag_paths(graph)
+        cycle, _, dag, topological_paths = next(results)
+        self.assertIn(cycle, cycles)
+        self.assertIsNotNone(dag)
+        first_path = next(topological_paths)
+        self.assertIn(first_path, paths)
+
+        streamed_paths = {first_path, *topological_paths}
+        for _, _, _, topological_paths in results:
+            streamed_paths.update(topological_paths)
+        self.assertEqual(paths, streamed_paths)
+
+    def test_cycle_length_bound_and_iterative_deepening(self):
+        set_self_loop_budget(1)
+        graph = create_graph_from_system(example_12())
+        cycles, _, _ = dfs_cycles(graph, get_valid_starting_nodes(graph))
+        max_length = max(len(c) for c in cycles)
+
+        set_max_cycle_length(max_length - 1)
+        try:
+            status = AnalysisStatus()
+            bounded_cycles, _, _ = dfs_cycles(graph, get_valid_starting_nodes(graph), status)
+        finally:
+            set_max_cycle_length(None)
+        self.assertEqual({c for c in cycles if len(c) < max_length}, bounded_cycles)
+        self.assertTrue(status.length_bound_reached)
+
+        lengths, checkpoints = [], []
+        set_iterative_deepening(True)
+        try:
+            status = AnalysisStatus()
+            for cycle, _, _ in iter_cycles(graph, get_valid_starting_nodes(graph), status,
+                                           lambda length: checkpoints.append((length, len(lengths)))):
+                lengths.append(len(cycle))
+            deepened_cycles, _, _ = dfs_cycles(graph, get_valid_starting_nodes(graph))
+        finally:
+            set_iterative_deepening(False)
+            set_self_loop_budget(0)
+
+        self.assertEqual(cycles, deepened_cycles)
+        self.assertEqual(sorted(lengths), lengths)
+        # each checkpoint comes once all the cycles up to its length are out
+        for length, found in checkpoints:
+            self.assertEqual(len([l for l in lengths if l <= length]), found)
+        self.assertEqual(status.complete_length, checkpoints[-1][0])
+        self.assertGreaterEqual(status.complete_length, max_length)
+
+    def test_used_edges_show_the_edge_conditions(self):
+        graph = create_graph_from_system(example_10())
+        _, used_edges, _ = dfs_cycles(graph, get_valid_starting_nodes(graph))
+
+        labels = {label for edges in used_edges.values() for _, label in edges}
+        self.assertTrue(any(label.startswith("z3[") for label in labels))
+        self.assertFalse(any(label.startswith("z3 condition") for label in labels))